@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio API to list files in a directory
+
+Directories are read off the event loop in the default executor, each read
+returning the entries of a directory at once, with a semaphore limiting the
+number of concurrent reads.
+
+author: Cedric ROMAN (roman@numengo.com)
+licence: GNU GPLv3
+"""
+import asyncio
+import os.path
+import pathlib
+
+from .entries import FileEntry
+from .index import ListingIndex
+from .list_files import _archive_lister
+from .list_files import _log_counts
+from .list_files import _roots
+from .list_files import _scan_dir
+from .list_files import _split_src
+from .list_files import scandir
+from .patterns import PatternSet
+
+
+async def ayield_entries(src,
+                         includes=["*"],
+                         excludes=[],
+                         recursive=False,
+                         in_parents=False,
+                         folders=0,
+                         workers=4,
+                         ordered=False,
+                         index=None,
+                         into_archives=False):
+    """
+    List directory entries in a source path with a list of given patterns,
+    without blocking the event loop
+
+    Same parameters as `yield_entries`. Entries are yielded as soon as their
+    directory is read.
+
+    :param workers: maximum number of directories read concurrently
+    :param ordered: yield entries in the same order as a serial listing
+    :rtype: os.DirEntry
+    """
+    if type(src) in [list, set, tuple]:
+        for s in src:
+            async with _aclosing(
+                    ayield_entries(s, includes, excludes, recursive,
+                                   in_parents, folders, workers, ordered,
+                                   index, into_archives)) as agen:
+                async for e in agen:
+                    yield e
+        return
+
+    loop = asyncio.get_event_loop()
+    src, includes = _split_src(src, includes)
+    exists, is_dir = await loop.run_in_executor(
+        None, lambda: (os.path.exists(src), os.path.isdir(src)))
+    if not exists:
+        raise IOError('impossible to list file in non existing directory %s',
+                      src)
+    if not is_dir:  # it s a file, returns it
+        yield FileEntry(src)
+        return
+
+    patterns = PatternSet.compile(includes, excludes)
+
+    if index is not None and not hasattr(index, 'scandir'):
+        index = ListingIndex(index)
+        try:
+            async with _aclosing(
+                    ayield_entries(src, patterns, None, recursive,
+                                   in_parents, folders, workers, ordered,
+                                   index, into_archives)) as agen:
+                async for e in agen:
+                    yield e
+        finally:
+            index.close()
+        return
+    lister = index.scandir if index is not None else scandir
+    if into_archives:
+        lister = _archive_lister(lister)
+
+    semaphore = asyncio.Semaphore(max(workers or 1, 1))
+
+    async def scan(path, patterns):
+        async with semaphore:
+            return await loop.run_in_executor(None, _scan_dir, path,
+                                              patterns, recursive, folders,
+                                              lister, into_archives)
+
+    walker = _awalk_ordered if ordered else _awalk
+    # maximum number of directories read ahead of the consumer
+    bound = 4 * max(workers or 1, 1)
+    for srcdir, patterns2, in_parent in _roots(src, patterns, in_parents):
+        counts = [0, 0]  # files and inner directories counters
+        async with _aclosing(walker(scan, srcdir, patterns2, counts,
+                                    bound)) as agen:
+            async for e in agen:
+                yield e
+        _log_counts(srcdir, counts, in_parent)
+    if index is not None:
+        index.flush()
+
+
+async def _awalk(scan, srcdir, patterns, counts, queue_size=4):
+    """
+    Yield entries of a directory as soon as directories are read, in no
+    particular order
+
+    :param queue_size: maximum number of directories read (or being read)
+                       and not consumed yet
+    """
+    loop = asyncio.get_event_loop()
+    tasks = set()
+    # read-ahead is bounded by slots, the queue is not: done callbacks of
+    # cancelled reads must not fail to put them
+    results = asyncio.Queue()
+    slots = asyncio.Semaphore(queue_size)
+
+    async def read(path, patterns):
+        # a directory is read once a slot is released by the consumer
+        await slots.acquire()
+        return await scan(path, patterns)
+
+    def submit(path, patterns):
+        task = loop.create_task(read(path, patterns))
+        task.add_done_callback(results.put_nowait)
+        tasks.add(task)
+
+    try:
+        submit(srcdir, patterns)
+        while tasks:
+            task = await results.get()
+            tasks.discard(task)
+            slots.release()
+            for item in task.result():
+                if isinstance(item, tuple):
+                    counts[1] += 1
+                    submit(*item)
+                else:
+                    counts[0] += 1
+                    yield item
+    finally:
+        # cancel pending reads if the generator is not exhausted
+        await _cancel(tasks)
+
+
+async def _awalk_ordered(scan, srcdir, patterns, counts, prefetch=4):
+    """
+    Yield entries of a directory in the same order as a serial listing, sub
+    directories being read ahead as soon as their parent is read, with at
+    most `prefetch` directories read in advance
+
+    :param prefetch: maximum number of directories read in advance
+    """
+    loop = asyncio.get_event_loop()
+    tasks = set()
+
+    def submit(item):
+        task = loop.create_task(scan(*item))
+        tasks.add(task)
+        return task
+
+    async def walk(task):
+        items = await task
+        tasks.discard(task)
+        # read ahead sub directories
+        subtasks = {}
+        for i, item in enumerate(items):
+            if isinstance(item, tuple) and len(tasks) < prefetch:
+                subtasks[i] = submit(item)
+        for i, item in enumerate(items):
+            if isinstance(item, tuple):
+                counts[1] += 1
+                subtask = subtasks.get(i) or submit(item)
+                async with _aclosing(walk(subtask)) as agen:
+                    async for e in agen:
+                        yield e
+            else:
+                counts[0] += 1
+                yield item
+
+    task = submit((srcdir, patterns))
+    try:
+        async with _aclosing(walk(task)) as agen:
+            async for e in agen:
+                yield e
+    finally:
+        await _cancel(tasks)
+
+
+class _aclosing(object):
+    """
+    Close an asynchronous generator on exit, so that pending reads are
+    cancelled as soon as a listing is interrupted
+    """
+
+    def __init__(self, agen):
+        self._agen = agen
+
+    async def __aenter__(self):
+        return self._agen
+
+    async def __aexit__(self, *exc_info):
+        await self._agen.aclose()
+
+
+async def _cancel(tasks):
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def ayield_files(src,
+                       includes=["*"],
+                       excludes=[],
+                       recursive=False,
+                       in_parents=False,
+                       folders=0,
+                       workers=4,
+                       ordered=False,
+                       index=None,
+                       into_archives=False):
+    """
+    List files in a source path with a list of given patterns, without
+    blocking the event loop
+
+    Same parameters as `yield_files`. Files are yielded as soon as their
+    directory is read.
+
+    :param workers: maximum number of directories read concurrently
+    :param ordered: yield files in the same order as a serial listing
+    :rtype: path
+    """
+    async with _aclosing(
+            ayield_entries(src, includes, excludes, recursive, in_parents,
+                           folders, workers, ordered, index,
+                           into_archives)) as agen:
+        async for e in agen:
+            yield pathlib.Path(e.path)
+
+
+async def alist_files(src,
+                      includes=["*"],
+                      excludes=[],
+                      recursive=False,
+                      in_parents=False,
+                      folders=0,
+                      workers=4,
+                      ordered=False,
+                      index=None,
+                      into_archives=False):
+    __doc__ = ayield_files.__doc__
+    return [
+        f async for f in ayield_files(src, includes, excludes, recursive,
+                                      in_parents, folders, workers, ordered,
+                                      index, into_archives)
+    ]
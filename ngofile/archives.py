@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+indexes of archive members, to list files in archives
+
+author: Cedric ROMAN (roman@numengo.com)
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import logging
+import os
+import re
+import stat
+import tarfile
+import threading
+import weakref
+import zipfile
+from builtins import object
+from builtins import str
+
+from future.utils import text_to_native_str
+
+from .exceptions import NotAnArchiveException
+from .exceptions import NotAZipArchiveException
+
+try:
+    import zstandard
+except ImportError:  # optional, to read .tar.zst archives
+    zstandard = None
+
+try:
+    import py7zr
+except ImportError:  # optional, to read .7z archives
+    py7zr = None
+
+logger = logging.getLogger(__name__)
+
+# maximum number of archive indexes kept in cache by path (and of compiled
+# member patterns)
+CACHE_SIZE = 64
+
+# separator between an archive path and a member path in virtual paths
+ARCHIVE_SEP = '!/'
+
+ARCHIVE_EXTENSIONS = ('.zip', '.jar', '.whl', '.tar', '.tar.gz', '.tgz',
+                      '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.tar.zst',
+                      '.tzst', '.7z')
+
+
+def is_archive(name):
+    """ return True if a file name has the extension of a supported archive """
+    return name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+_magic_check = re.compile('[*?[]')
+
+# compiled regexes of include/exclude patterns
+_regex_cache = {}
+
+
+def _translate(pattern, recursive):
+    """
+    Translate a shell pattern to a regex matching a member path
+
+    In a recursive listing, wildcards also match the path separator.
+    """
+    star, qmark = ('.*', '.') if recursive else ('[^/]*', '[^/]')
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            res.append(star)
+        elif c == '?':
+            res.append(qmark)
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] in '!]':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                res.append('\\[')
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                if stuff[0] == '!':
+                    stuff = '^' + stuff[1:]
+                res.append('[%s]' % stuff)
+                i = j + 1
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
+
+
+def _compile(patterns, recursive):
+    key = (patterns, recursive)
+    rx = _regex_cache.get(key)
+    if rx is None:
+        rx = r'|'.join(
+            ['(?:%s)\\Z' % _translate(p, recursive) for p in patterns])
+        rx = re.compile(rx or r'$.', re.DOTALL)
+        if len(_regex_cache) >= CACHE_SIZE:
+            _regex_cache.clear()
+        _regex_cache[key] = rx
+    return rx
+
+
+def _normalize(patterns):
+    if not isinstance(patterns, (list, set, frozenset, tuple)):
+        patterns = [patterns]
+    return tuple(sorted(set([str(p).replace('\\', '/') for p in patterns])))
+
+
+class ArchiveEntry(object):
+    """
+    Archive member with the interface of ``os.DirEntry``
+
+    Its path is a virtual path made of the archive path and the member path
+    (``a/b.zip!/inner/x.py``), its stat result only holds type and size.
+    """
+    __slots__ = ('name', 'path', '_is_dir', '_size')
+
+    def __init__(self, path, is_dir, size=0):
+        self.path = path
+        self.name = path.rstrip('/').rpartition('/')[2]
+        self._is_dir = is_dir
+        self._size = size or 0
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.name)
+
+    def __fspath__(self):
+        return self.path
+
+    def stat(self, follow_symlinks=True):
+        mode = stat.S_IFDIR | 0o755 if self._is_dir else stat.S_IFREG | 0o644
+        return os.stat_result((mode, 0, 0, 0, 0, 0, self._size, 0, 0, 0))
+
+    def is_dir(self, follow_symlinks=True):
+        return self._is_dir
+
+    def is_file(self, follow_symlinks=True):
+        return not self._is_dir
+
+    def is_symlink(self):
+        return False
+
+    def inode(self):
+        return 0
+
+
+class ArchiveIndex(object):
+    """
+    Prefix tree of the member names of an archive
+
+    The tree is built once from the member names, include/exclude/recursive
+    queries then only visit the sub trees designated by the literal part of
+    include patterns (and only the depth they can match in a non recursive
+    query), instead of matching all names of the archive.
+    """
+    _zip_indexes = weakref.WeakKeyDictionary()
+    _tar_indexes = weakref.WeakKeyDictionary()
+    _path_indexes = {}
+    _lock = threading.Lock()
+
+    def __init__(self, names, sizes=None):
+        """
+        Build the index from member names ('/' separated, directories ending
+        with a '/')
+
+        :param names: member names, in archive order
+        :type names: list
+        :param sizes: member sizes (uncompressed)
+        :type sizes: list
+        """
+        self.names = list(names)
+        self.sizes = list(sizes) if sizes is not None else None
+        self._members = {'': []}  # members directly in a directory
+        self._subdirs = {'': []}  # sub directories of a directory
+        self._dirmember = {}  # index of directory members
+        for i, n in enumerate(self.names):
+            path = n.rstrip('/')
+            if n.endswith('/'):
+                self._dirmember[path] = i
+            parent = self._add_dir(path.rpartition('/')[0])
+            self._members[parent].append(i)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return '<%s[%i members]>' % (self.__class__.__name__, len(self))
+
+    def _add_dir(self, path):
+        if path not in self._members:
+            self._members[path] = []
+            self._subdirs[path] = []
+            parent = self._add_dir(path.rpartition('/')[0])
+            self._subdirs[parent].append(path)
+        return path
+
+    @classmethod
+    def for_zip(cls, archive):
+        """
+        Return the index of a zip file, built once per ZipFile object
+
+        :param archive: zipfile to index
+        :type archive: zipfile.ZipFile
+        :rtype: ArchiveIndex
+        """
+        if not isinstance(archive, zipfile.ZipFile):
+            raise NotAZipArchiveException('%r is not a valid zip file' %
+                                          archive)
+        index = cls._zip_indexes.get(archive)
+        if index is None:
+            index = cls._from_members(
+                [(i.filename, i.file_size) for i in archive.infolist()])
+            cls._zip_indexes[archive] = index
+        return index
+
+    @classmethod
+    def for_tar(cls, archive):
+        """
+        Return the index of a tar file, built once per TarFile object
+
+        :param archive: tarfile to index
+        :type archive: tarfile.TarFile
+        :rtype: ArchiveIndex
+        """
+        if not isinstance(archive, tarfile.TarFile):
+            raise NotAnArchiveException('%r is not a valid tar file' %
+                                        archive)
+        index = cls._tar_indexes.get(archive)
+        if index is None:
+            index = cls._from_members(_tar_members(archive))
+            cls._tar_indexes[archive] = index
+        return index
+
+    @classmethod
+    def get(cls, archive, quiet=False):
+        """
+        Return the index of an archive
+
+        Archives given by path are read once (tar archives are streamed,
+        without being extracted nor loaded), their index is cached until
+        the archive file is modified. Archives which cannot be read are
+        cached as well, and not read again until they are modified.
+
+        :param archive: archive object (ZipFile, TarFile) or path (zip, tar,
+                        tar.gz, tar.bz2, tar.xz, tar.zst, 7z)
+        :param quiet: return None for an archive which cannot be read, with
+                      a warning the first time it is read, instead of
+                      raising NotAnArchiveException
+        :type quiet: bool
+        :rtype: ArchiveIndex
+        """
+        if isinstance(archive, zipfile.ZipFile):
+            return cls.for_zip(archive)
+        if isinstance(archive, tarfile.TarFile):
+            return cls.for_tar(archive)
+        path = os.path.abspath(text_to_native_str(str(archive)))
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise NotAnArchiveException('%r is not a valid archive' %
+                                        archive)
+        sig = (st.st_size, st.st_mtime)
+        with cls._lock:
+            cached = cls._path_indexes.get(path)
+        if cached is not None and cached[0] == sig:
+            index = cached[1]
+        else:
+            try:
+                index = cls._from_members(_read_members(path))
+            except NotAnArchiveException as er:
+                index = er
+            except (IOError, OSError, zipfile.BadZipfile) as er:
+                index = NotAnArchiveException('impossible to read %s: %s' %
+                                              (path, er))
+            if quiet and not isinstance(index, cls):
+                logger.warning('impossible to list archive %s: %s', path,
+                               index)
+            with cls._lock:
+                if len(cls._path_indexes) >= CACHE_SIZE:
+                    cls._path_indexes.clear()
+                cls._path_indexes[path] = (sig, index)
+        if not isinstance(index, cls):
+            if quiet:
+                return None
+            raise NotAnArchiveException(str(index))
+        return index
+
+    @classmethod
+    def _from_members(cls, members):
+        """ build index from a list of (name, size) """
+        names, sizes = [], []
+        for n, size in members:
+            names.append(n)
+            sizes.append(size)
+        return cls(names, sizes)
+
+    def scandir(self, path='', prefix=''):
+        """
+        List a directory of the archive
+
+        :param path: directory path in archive ('' for archive root)
+        :type path: str
+        :param prefix: prefix of entry paths (archive path and separator)
+        :type prefix: str
+        :rtype: list, items:{type: ArchiveEntry}
+        """
+        path = path.strip('/')
+        if path not in self._members:
+            return []
+        sizes = self.sizes
+        entries = [
+            ArchiveEntry(prefix + self.names[i], False,
+                         sizes[i] if sizes else 0)
+            for i in self._members[path] if not self.names[i].endswith('/')
+        ]
+        entries.extend([
+            ArchiveEntry(prefix + d, True) for d in self._subdirs[path]
+        ])
+        return entries
+
+    def is_dir(self, path):
+        """ return True if path (without trailing '/') is a directory """
+        return path in self._members
+
+    def _subtree(self, path):
+        """ yield member indices of a directory and all its sub directories """
+        stack = [path]
+        while stack:
+            d = stack.pop()
+            for i in self._members[d]:
+                yield i
+            stack.extend(self._subdirs[d])
+
+    def query(self, includes=["*"], excludes=[], recursive=False):
+        """
+        Return member names matching patterns, in archive order
+
+        Include patterns are matched against member paths, in a recursive
+        query wildcards also match the path separator. Directories matched
+        select their content (only their direct children in a non recursive
+        query). Members whose path ends with an exclude pattern are
+        excluded.
+
+        :param includes: pattern or list of patterns ('*.py', '*.txt', etc...)
+        :type includes: [str,list]
+        :param excludes: patterns to exclude
+        :type excludes: [str,list]
+        :param recursive: list files recursively
+        :rtype: list
+        """
+        includes = _normalize(includes)
+        excludes = _normalize(excludes)
+        exclp = _compile(excludes, True)
+        selected = set()
+        for pattern in includes:
+            inclp = _compile((pattern, ), recursive)
+            segs = pattern.strip('/').split('/')
+            nbase = 0
+            while nbase < len(segs) - 1 and not _magic_check.search(
+                    segs[nbase]):
+                nbase += 1
+            base = '/'.join(segs[:nbase])
+            if base not in self._members:
+                continue
+            depth = len(segs) - nbase
+            if recursive and _magic_check.search(pattern):
+                depth = None
+            stack = [(base, 1)]
+            while stack:
+                d, level = stack.pop()
+                if depth is None or level == depth:
+                    for i in self._members[d]:
+                        n = self.names[i]
+                        if not n.endswith('/') and inclp.match(n):
+                            selected.add(i)
+                for sub in self._subdirs[d]:
+                    if (depth is None or level == depth) and inclp.match(sub):
+                        if sub in self._dirmember:
+                            selected.add(self._dirmember[sub])
+                        if recursive:
+                            # the whole sub tree is selected
+                            selected.update(self._subtree(sub))
+                            continue
+                        selected.update(self._members[sub])
+                    if depth is None or level < depth:
+                        stack.append((sub, level + 1))
+        return [
+            self.names[i] for i in sorted(selected)
+            if exclp.search(self.names[i]) is None
+        ]
+
+
+def _tar_members(tar, stream=False):
+    """
+    yield (name, size) of members of a tar file, directories ending with
+    a '/'
+    """
+    for m in tar:
+        n = m.name
+        if n.startswith('./'):
+            n = n[2:]
+        if not n or n == '.':
+            continue
+        if m.isdir() and not n.endswith('/'):
+            n += '/'
+        yield n, m.size
+        if stream:
+            # members do not need to be kept when streaming
+            tar.members = []
+
+
+def _read_members(path):
+    """ read (name, size) of members of an archive file """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as z:
+            return [(i.filename, i.file_size) for i in z.infolist()]
+    lower = path.lower()
+    if lower.endswith(('.zst', '.tzst')):
+        if zstandard is None:
+            raise NotAnArchiveException(
+                'zstandard is required to read %s' % path)
+        with open(path, 'rb') as fh:
+            reader = zstandard.ZstdDecompressor().stream_reader(fh)
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                return list(_tar_members(tar, stream=True))
+    if lower.endswith('.7z'):
+        if py7zr is None:
+            raise NotAnArchiveException('py7zr is required to read %s' % path)
+        with py7zr.SevenZipFile(path, 'r') as z:
+            return [(f.filename + '/', 0) if f.is_directory else
+                    (f.filename, f.uncompressed) for f in z.list()]
+    try:
+        with tarfile.open(path, 'r|*') as tar:
+            return list(_tar_members(tar, stream=True))
+    except (tarfile.TarError, EOFError):
+        raise NotAnArchiveException('%r is not a valid archive' % path)
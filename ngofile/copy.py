@@ -4,135 +4,548 @@ Misc copy utilities
 """
 from __future__ import unicode_literals
 
+import collections
+import errno
 import filecmp
-import fnmatch
+import functools
 import logging
 import os
 import os.path
-import re
 import shutil
 import sys
+import threading
 from builtins import str
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from future.utils import text_to_native_str
 
 from . import get_unicode
+from .copyfile import copyfile
+from .copyfile import copyfile_many
+from .copyfile import SafeWriter
+from .dedup import Deduplicator
+from .digests import DigestCache
 from .exceptions import CopyException
 from .exceptions import NgoFileException
 from .exceptions import NotADirectoryException
 from .exceptions import NotExistingPathException
+from .journal import CopyJournal
+from .list_files import scandir
+from .patterns import PatternSet
+from .plan import CopyPlan
 
 enc = sys.stdout.encoding or "cp850"
 
 
-def _copy(src, dst):
+# maximum number of pending file copies per worker in a parallel copy
+QUEUE_FACTOR = 4
+
+# strategies to decide whether an existing destination file is up to date:
+# 'content': same stat signature or same content (filecmp)
+# 'mtime+size': same size and modification time (quick check, as rsync)
+# 'checksum': same size and content digest (digests are cached)
+# 'always': files are always copied
+SYNC_STRATEGIES = ('content', 'mtime+size', 'checksum', 'always')
+
+
+def _is_uptodate(src, dst, sync='content', digests=None, src_st=None,
+                 dst_st=None):
+    """
+    Return True if an existing destination file does not need to be copied
+
+    :param src: source file
+    :param dst: destination file
+    :param sync: sync strategy (see SYNC_STRATEGIES)
+    :param digests: digest cache used by checksum strategy
+    :type digests: DigestCache
+    :param src_st: stat result of source file, if already known
+    :param dst_st: stat result of destination file, if already known
+    :rtype: bool
+    """
+    if sync == 'always':
+        return False
+    try:
+        dst_st = dst_st or os.stat(dst)
+    except OSError:
+        return False
+    if sync == 'content':
+        return filecmp.cmp(src, dst)
+    src_st = src_st or os.stat(src)
+    if src_st.st_size != dst_st.st_size:
+        return False
+    if sync == 'mtime+size':
+        # compared to the second, as file systems have different precisions
+        return int(src_st.st_mtime) == int(dst_st.st_mtime)
+    return digests.digest(src, src_st) == digests.digest(dst, dst_st)
+
+
+def _copy(src, dst, sync='content', digests=None, src_st=None,
+          backends=None, journal=None, writer=None, dedup=None):
     """
     Copy a file src to dst (directory).
     
-    If dst exists and is the same, nothing is done
+    If dst exists and is up to date, nothing is done. Content is copied by
+    the fastest backend available (see `copyfile`), then file stats.
+
+    With a journal, files recorded as copied are skipped without being
+    compared, and a partial copy is resumed at its offset.
+
+    With a writer, the file written and its commit to dst depend on its
+    atomic and fsync modes (see `SafeWriter`).
+
+    With a deduplicator, dst is linked to an identical file if there is one
+    (see `Deduplicator`).
 
     :param src: source file or directory
     :type src: path
     :param dst: destination file or directory
     :type dst: path
+    :param sync: sync strategy (see SYNC_STRATEGIES)
+    :param digests: digest cache used by checksum strategy
+    :type digests: DigestCache
+    :param src_st: stat result of source file, if already known
+    :param backends: names of copy backends to try (all by default)
+    :param journal: copy journal
+    :type journal: CopyJournal
+    :param writer: safe writer
+    :type writer: SafeWriter
+    :param dedup: deduplicator
+    :type dedup: Deduplicator
+    :return: name of the copy backend used, None if dst is up to date
+    :rtype: str
     """
     logger = logging.getLogger(__name__)
-    src = text_to_native_str(src)
-    dst = text_to_native_str(dst)
-    if os.path.exists(dst) and os.path.isdir(dst):
+    src = text_to_native_str(str(src))
+    dst = text_to_native_str(str(dst))
+    if os.path.isdir(dst):
         dst = os.path.join(dst, os.path.basename(src))
-    if os.path.exists(dst):
-        if not filecmp.cmp(src, dst):
-            logger.debug('updating %s', get_unicode(dst, enc))
-            shutil.copy2(src, dst)
-        else:
-            logger.debug('%s already up to date', get_unicode(dst, enc))
+    if sync == 'checksum' and digests is None:
+        digests = DigestCache()
+    target = dst if writer is None else writer.target(dst)
+    offset, progress = 0, None
+    if journal is not None:
+        src_st = src_st or os.stat(src)
+        if journal.is_done(dst, src_st):
+            logger.debug('%s already copied', get_unicode(dst, enc))
+            return None
+        offset = journal.offset(target, src_st)
+        progress = functools.partial(journal.set_offset, src, target,
+                                     src_st)
+    if not offset and _is_uptodate(src, dst, sync, digests, src_st):
+        logger.debug('%s already up to date', get_unicode(dst, enc))
+        if journal is not None:
+            journal.set_done(src, dst, src_st)
+        return None
+    if dedup is not None and not offset:
+        backend = dedup.link(src, dst, src_st)
+        if backend is not None:
+            logger.debug('link %s to an identical file (%s)',
+                         get_unicode(dst, enc), backend)
+            # (linked file replaced dst, its directory entry is new)
+            _commit(src, dst, dst, digests, src_st, journal, writer,
+                    created=True)
+            return backend
+    if offset:
+        logger.debug('resume copy of %s at %i', get_unicode(dst, enc),
+                     offset)
+    try:
+        backend = copyfile(src, target, backends, offset=offset,
+                           progress=progress)
+        shutil.copystat(src, target)
+    except (IOError, os.error):
+        # (a partial temporary file is kept for a journal to resume it)
+        if journal is None:
+            _discard(target, dst)
+        raise
+    logger.debug('copy %s to %s (%s)', get_unicode(src, enc),
+                 get_unicode(dst, enc), backend)
+    _commit(src, target, dst, digests, src_st, journal, writer, dedup)
+    return backend
+
+
+def _discard(target, dst):
+    """ remove the temporary file of a failed copy """
+    if target != dst:
+        try:
+            os.remove(target)
+        except OSError:
+            pass
+
+
+def _commit(src, target, dst, digests, src_st, journal, writer=None,
+            dedup=None, created=False):
+    """ commit a copied file to its destination, and record it """
+
+    def done():
+        _record_digest(src, dst, digests, src_st)
+        if journal is not None:
+            journal.set_done(src, dst, src_st)
+        if dedup is not None:
+            dedup.add(src, dst, src_st)
+
+    if writer is None:
+        done()
     else:
-        logger.debug('copy %s to %s', get_unicode(src, enc),
-                     get_unicode(dst, enc))
-        shutil.copy2(src, dst)
+        writer.commit(target, dst, done, created)
+
+
+def _record_digest(src, dst, digests, src_st=None):
+    """ record digest of a copied file, known without reading it again """
+    if digests is not None:
+        src_st = src_st or os.stat(src)
+        dst_st = os.stat(dst)
+        if dst_st.st_size == src_st.st_size:
+            digests.set(dst, dst_st, digests.digest(src, src_st))
+
+
+def _copy_fanout(src, dsts, sync='content', digests=None, src_st=None,
+                 backends=None, errors=None, journal=None, writer=None,
+                 dedup=None):
+    """
+    Copy a file src to several destination files, reading it only once
+
+    :param src: source file
+    :type src: path
+    :param dsts: destination files
+    :type dsts: list
+    :param errors: list where errors of destinations are appended (raised
+                   otherwise)
+    :param journal: copy journal (destinations recorded as copied are
+                    skipped, partial copies are only resumed for a single
+                    destination)
+    :type journal: CopyJournal
+    :param writer: safe writer
+    :type writer: SafeWriter
+    :param dedup: deduplicator (destinations written together are not
+                  linked, but recorded for next files)
+    :type dedup: Deduplicator
+    :return: name of the copy backend used ('fanout' if several
+             destinations were not up to date), None if all destinations
+             are up to date
+    :rtype: str
+    """
+    logger = logging.getLogger(__name__)
+    src = text_to_native_str(str(src))
+    if journal is not None:
+        src_st = src_st or os.stat(src)
+        dsts = [d for d in dsts if not journal.is_done(d, src_st)]
+    stale = [
+        d for d in dsts if not _is_uptodate(src, d, sync, digests, src_st)
+    ]
+    for d in dsts:
+        if d not in stale:
+            logger.debug('%s already up to date', get_unicode(d, enc))
+            if journal is not None:
+                journal.set_done(src, d, src_st)
+    if len(stale) <= 1:
+        if stale:
+            return _copy(src, stale[0], 'always', digests, src_st, backends,
+                         journal, writer, dedup)
+        return None
+    targets = [d if writer is None else writer.target(d) for d in stale]
+    failed = copyfile_many(src, targets)
+    for d, t in zip(stale, targets):
+        try:
+            if t in failed:
+                raise failed[t]
+            shutil.copystat(src, t)
+            _commit(src, t, d, digests, src_st, journal, writer, dedup)
+            logger.debug('copy %s to %s (fanout)', get_unicode(src, enc),
+                         get_unicode(d, enc))
+        except (IOError, os.error) as why:
+            _discard(t, d)
+            if errors is None:
+                raise
+            errors.append((src, d, str(why)))
+    return 'fanout'
 
 
-def _copytree(src, dst, excludes=[], includes=[], recursive=True):
+def _walk_tree(src, dsts, patterns, recursive, errors, mirror=False):
+    """
+    Walk a source directory and yield the copy operations, in order:
+
+    * ``('dir', srcdir, dstdirs, None)`` before the content of a directory
+    * ``('file', srcfile, dstfiles, entry)`` for each file to copy
+    * ``('delete', srcdir, (dstpath, ), is_dir)`` in mirror mode, for each
+      extraneous destination file or directory (directories after their
+      content), found by listing each destination directory along with its
+      source directory
+    * ``('enddir', srcdir, dstdirs, None)`` after the content of a directory
+
+    :param src: source directory
+    :param dsts: destination directories
+    :type dsts: tuple
+    :param patterns: compiled patterns
+    :type patterns: PatternSet
+    :param recursive: recursive copy
+    :param errors: list where listing errors are appended
+    :param mirror: yield extraneous destination files
+    """
+    yield 'dir', src, dsts, None
+    try:
+        entries = list(scandir(src))
+    except OSError as why:
+        errors.append((src, dsts[0], str(why)))
+        entries = None
+    extras = []
+    if mirror and entries is not None:
+        names = set([e.name for e in entries])
+        for d in dsts:
+            try:
+                extra = [e for e in scandir(d) if e.name not in names]
+            except OSError:
+                continue  # (destination not created yet)
+            extras.extend(_walk_extra(extra, patterns, recursive))
+    for entry in entries or []:
+        if patterns.exclude(entry.name, entry.path):
+            continue
+        dstnames = tuple([os.path.join(d, entry.name) for d in dsts])
+        try:
+            is_dir = entry.is_dir()
+        except OSError as why:
+            errors.append((entry.path, dstnames[0], str(why)))
+            continue
+        if is_dir:
+            patterns2 = patterns.descend(entry.name, recursive)
+            if patterns2 is not None:
+                for op in _walk_tree(entry.path, dstnames, patterns2,
+                                     recursive, errors, mirror):
+                    yield op
+        elif patterns.include(entry.name):
+            yield 'file', entry.path, dstnames, entry
+    for path, is_dir in extras:
+        yield 'delete', src, (path, ), is_dir
+    yield 'enddir', src, dsts, None
+
+
+def _walk_extra(entries, patterns, recursive):
+    """
+    Yield (path, is_dir) of extraneous destination entries selected by
+    patterns, with the content of directories before them (excluded entries
+    are kept, as rsync does)
+    """
+    for entry in entries:
+        if patterns.exclude(entry.name, entry.path):
+            continue
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+        except OSError:
+            is_dir = False
+        if is_dir:
+            patterns2 = patterns.descend(entry.name, recursive)
+            if patterns2 is None:
+                continue
+            try:
+                content = list(scandir(entry.path))
+            except OSError:
+                content = []
+            for extra in _walk_extra(content, patterns2, recursive):
+                yield extra
+            yield entry.path, True
+        elif patterns.include(entry.name):
+            yield entry.path, False
+
+
+def _delete(deletes, errors):
+    """
+    Delete extraneous destination files and directories, and return the
+    number deleted (directories keeping excluded files are kept)
+    """
+    logger = logging.getLogger(__name__)
+    deleted = 0
+    for path, is_dir in deletes:
+        logger.debug('delete %s', get_unicode(path, enc))
+        try:
+            if is_dir:
+                os.rmdir(path)
+            else:
+                os.remove(path)
+            deleted += 1
+        except OSError as why:
+            if why.errno == errno.ENOENT:
+                continue
+            if is_dir and why.errno in (errno.ENOTEMPTY, errno.EEXIST):
+                continue
+            errors.append((None, path, str(why)))
+    return deleted
+
+
+def _copy_file(src, dsts, entry, sync, digests, errors, backends=None,
+               journal=None, writer=None, dedup=None):
+    """
+    copy a file of a tree to its destinations, appending error to errors,
+    and return the copy backend used, 'uptodate' or 'failed'
+    """
+    try:
+        if len(dsts) == 1:
+            return _copy(src, dsts[0], sync, digests, entry.stat(), backends,
+                         journal, writer, dedup) or 'uptodate'
+        return _copy_fanout(src, dsts, sync, digests, entry.stat(), backends,
+                            errors, journal, writer, dedup) or 'uptodate'
+    except (IOError, os.error) as why:
+        errors.extend([(src, d, str(why)) for d in dsts])
+        return 'failed'
+
+
+def _end_dir(src, dsts, errors, writer=None, deletes=None):
+    """
+    commit the files pending in destination directories, delete extraneous
+    files, then copy directory stats, and return the number of files deleted
+    """
+    if writer is not None:
+        for dst in dsts:
+            try:
+                writer.end_dir(dst)
+            except (IOError, os.error) as why:
+                errors.append((src, dst, str(why)))
+    deleted = _delete(deletes, errors) if deletes else 0
+    for dst in dsts:
+        _copystat(src, dst, errors)
+    return deleted
+
+
+def _copystat(src, dst, errors):
+    try:
+        shutil.copystat(src, dst)
+    except OSError as why:
+        if sys.platform != 'win32':
+            # (can't copy file access times on Windows)
+            errors.append((src, dst, str(why)))
+
+
+def _copytree(src,
+              dst,
+              excludes=[],
+              includes=[],
+              recursive=True,
+              sync='content',
+              digests=None,
+              workers=0,
+              backends=None,
+              journal=None,
+              writer=None,
+              dedup=None,
+              mirror=False):
     """ 
     Copy a directory structure src to destination
+
+    Directories are walked once, each file being copied only if its
+    destination is not up to date according to the sync strategy.
+
+    With several workers, files are copied in a thread pool while walking
+    (the walk waits when too many copies are pending). Directories are
+    created before their files are submitted, their stats are copied once
+    all copies are done.
     
     :param src: source file or directory
     :type src: path
-    :param dst: destination file or directory
-    :type dst: path
+    :param dst: destination directory, or list of destination directories
+                to copy to in a single walk, reading files only once
+    :type dst: [path,list]
     :param excludes: list of patterns to exclude
     :type excludes: ngomodel.validators.List
     :param includes: list of patterns to include
     :type includes: ngomodel.validators.List
     :param recursive: recursive copy
+    :param sync: sync strategy (see SYNC_STRATEGIES)
+    :param digests: digest cache used by checksum strategy
+    :type digests: DigestCache
+    :param workers: number of threads copying files
+    :param backends: names of copy backends to try (all by default)
+    :param journal: copy journal
+    :type journal: CopyJournal
+    :param writer: safe writer
+    :type writer: SafeWriter
+    :param dedup: deduplicator
+    :type dedup: Deduplicator
+    :param mirror: delete extraneous destination files
+    :return: number of files by copy backend used ('uptodate' for files up
+             to date, 'failed' for errors, 'deleted' for files deleted)
+    :rtype: collections.Counter
     """
     logger = logging.getLogger(__name__)
     # make sure to convert string from ngopath
     # convert everything to ngopath and back to string
     src = text_to_native_str(str(src))
-    dst = text_to_native_str(str(dst))
-
-    incl = r'|'.join([fnmatch.translate(x) for x in includes])
-    excl = r'|'.join([fnmatch.translate(x) for x in excludes]) or r'$.'
-
-    allnames = os.listdir(src)
-    names = [name for name in allnames if not re.match(excl, name)]
+    dsts = dst if isinstance(dst, (list, tuple)) else [dst]
+    dsts = tuple([text_to_native_str(str(d)) for d in dsts])
+    # (copy patterns are case sensitive)
+    patterns = PatternSet.compile(includes, excludes, case_sensitive=True)
+    if sync == 'checksum' and digests is None:
+        digests = DigestCache()
 
     errors = []
+    stats = collections.Counter()
+    lock = threading.Lock()
+    ops = _walk_tree(src, dsts, patterns, recursive, errors, mirror)
+    deletes = []
+    executor = None
+    if workers and workers > 1:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        # number of pending copies is bounded
+        pending = threading.BoundedSemaphore(workers * QUEUE_FACTOR)
+        enddirs = []
 
-    if not os.path.exists(dst):
-        logger.debug('making dir %s', get_unicode(dst, enc))
-        os.makedirs(dst)
-
-    for name in names:
-        srcname = os.path.join(src, name)
-        dstname = os.path.join(dst, name)
+    def release(future):
         try:
-            if os.path.isdir(srcname):
-                if recursive:
-                    _copytree(srcname, dstname, excludes, includes, recursive)
-                if re.match(incl, name) and recursive:
-                    _copytree(srcname, dstname, excludes, includes, recursive)
-            elif re.match(incl, name):
-                _copy(srcname, dstname)
-        except (IOError, os.error) as why:
-            errors.append((srcname, dstname, str(why)))
+            result = future.result()
+        except Exception as er:  # unexpected errors are reported too
+            errors.append((None, None, str(er)))
+            result = 'failed'
+        finally:
+            pending.release()
+        with lock:
+            stats[result] += 1
+
     try:
-        shutil.copystat(src, dst)
-    except WindowsError:
-        # can't copy file access times on Windows
-        pass
-    except OSError as why:
-        errors.extend((src, dst, str(why)))
+        for op, srcname, dstnames, entry in ops:
+            if op == 'dir':
+                for dstname in dstnames:
+                    if not os.path.exists(dstname):
+                        logger.debug('making dir %s',
+                                     get_unicode(dstname, enc))
+                        try:
+                            os.makedirs(dstname)
+                        except (IOError, os.error) as why:
+                            errors.append((srcname, dstname, str(why)))
+            elif op == 'file':
+                if executor is None:
+                    stats[_copy_file(srcname, dstnames, entry, sync, digests,
+                                     errors, backends, journal, writer,
+                                     dedup)] += 1
+                else:
+                    pending.acquire()
+                    executor.submit(_copy_file, srcname, dstnames, entry,
+                                    sync, digests, errors, backends, journal,
+                                    writer, dedup).add_done_callback(release)
+            elif op == 'delete':
+                # (deleted in bulk once their directory is done)
+                deletes.append((dstnames[0], entry))
+            elif executor is None:
+                stats['deleted'] += _end_dir(srcname, dstnames, errors,
+                                             writer, deletes)
+                deletes = []
+            else:
+                # (directories are walked in post order)
+                enddirs.append((srcname, dstnames, deletes))
+                deletes = []
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+    if executor is not None:
+        for srcname, dstnames, deletes in enddirs:
+            stats['deleted'] += _end_dir(srcname, dstnames, errors, writer,
+                                         deletes)
     if errors:
         raise CopyException(errors)
+    return stats
 
 
-def advanced_copy(src,
-                  dst,
-                  excludes=[],
-                  includes=[],
-                  recursive=True,
-                  create_directory=True):
-    """
-    Copy a directory structure src to destination
-    
-    :param src: source file or directory
-    :type src: string
-    :param dst: destination file or directory
-    :type dst: path
-    :param excludes: list of patterns to exclude
-    :type excludes: list
-    :param includes: list of patterns to include
-    :type includes: list
-    :param recursive: recursive copy
-    :param create_directory: create missing directories
-    """
-    logger = logging.getLogger(__name__)
+def _prepare(src, dst, includes, excludes):
+    """ normalize arguments of a copy """
     dsts = dst if isinstance(dst, list) else [dst]
-    dsts = [Path(text_to_native_str(f)) for f in dsts]
+    dsts = [Path(text_to_native_str(str(f))) for f in dsts]
     # not is dir because it might not exist if it s just being created
     includes = includes if isinstance(includes, list) else [includes]
     excludes = excludes if isinstance(excludes, list) else [excludes]
@@ -150,25 +563,364 @@ def advanced_copy(src,
 
     src = Path(src)
     assert src.exists()
+    return src, dsts, includes, excludes
 
-    for dst in dsts:
-        # do we need to create dst directories ?
-        parts = dst.parts
-        cur = Path(parts[0])
-        assert cur.exists(), '%s does not exist' % get_unicode(cur)
-        for p in parts[1:]:
-            cur = cur.joinpath(p)
-            if not cur.is_dir():
-                if not create_directory:
-                    raise NotADirectoryException(
-                        'Use create_directory option.', cur)
+
+def _make_dst(dst, create_directory=True, dry_run=False):
+    """
+    Create missing directories of a destination (only check them in a dry
+    run), and return the missing ones
+    """
+    logger = logging.getLogger(__name__)
+    missing = []
+    parts = dst.parts
+    cur = Path(parts[0])
+    assert cur.exists(), '%s does not exist' % get_unicode(cur)
+    for p in parts[1:]:
+        cur = cur.joinpath(p)
+        if missing or not cur.is_dir():
+            if not create_directory:
+                raise NotADirectoryException('Use create_directory option.',
+                                             cur)
+            missing.append(text_to_native_str(str(cur.absolute())))
+            if not dry_run:
                 logger.debug('creating directory %s', cur)
-                os.makedirs(text_to_native_str(str(cur.resolve())))
-        if src.is_file():
-            logger.debug('_copy(%s,%s)', get_unicode(str(src), enc),
-                         get_unicode(str(dst), enc))
-            _copy(src, dst)
+                os.makedirs(missing[-1])
+    return missing
+
+
+def plan_copy(src,
+              dst,
+              excludes=[],
+              includes=[],
+              recursive=True,
+              create_directory=True,
+              sync='content',
+              digest_cache=None,
+              mirror=False):
+    """
+    Plan a copy without copying anything
+
+    Source and destinations are walked once, to list the directories to
+    make and the files to create, update or skip according to the sync
+    strategy, with the number of bytes to copy (and in mirror mode the
+    extraneous destination files to delete).
+
+    Same parameters as `advanced_copy`.
+
+    :rtype: CopyPlan
+    """
+    if sync not in SYNC_STRATEGIES:
+        raise ValueError('unknown sync strategy %r' % sync)
+    if digest_cache is not None and not isinstance(digest_cache, DigestCache):
+        with DigestCache(digest_cache) as digest_cache:
+            return plan_copy(src, dst, excludes, includes, recursive,
+                             create_directory, sync, digest_cache, mirror)
+    if sync == 'checksum' and digest_cache is None:
+        digest_cache = DigestCache()
+    src, dsts, includes, excludes = _prepare(src, dst, includes, excludes)
+    plan = CopyPlan(src, dsts, sync=sync)
+    missing = set()
+    for d in dsts:
+        dirs = _make_dst(d, create_directory, dry_run=True)
+        plan.dirs.extend(dirs)
+        missing.update(dirs)
+    dsts = tuple([text_to_native_str(str(d)) for d in dsts])
+    if src.is_file():
+        st = src.stat()
+        dstnames = [os.path.join(d, src.name) for d in dsts]
+        plan.add_file(text_to_native_str(str(src)), st.st_size,
+                      **_plan_file(str(src), dstnames, sync, digest_cache, st))
+        return plan
+    errors = []
+    ops = _walk_tree(text_to_native_str(str(src)), dsts,
+                     PatternSet.compile(includes, excludes,
+                                        case_sensitive=True), recursive,
+                     errors, mirror)
+    for op, srcname, dstnames, entry in ops:
+        if op == 'dir':
+            for d in dstnames:
+                if (os.path.abspath(d) not in missing
+                        and not os.path.isdir(d)):
+                    plan.dirs.append(d)
+        elif op == 'file':
+            try:
+                st = entry.stat()
+                plan.add_file(srcname, st.st_size,
+                              **_plan_file(srcname, dstnames, sync,
+                                           digest_cache, st))
+            except (IOError, os.error) as why:
+                errors.append((srcname, dstnames[0], str(why)))
+        elif op == 'delete':
+            plan.deletes.append((dstnames[0], entry))
         else:
-            logger.debug('_copytree(%s,%s,...)', get_unicode(str(src), enc),
-                         get_unicode(str(dst), enc))
-            _copytree(src, dst, excludes, includes, recursive)
+            plan.dirstats.append((srcname, list(dstnames)))
+    if errors:
+        raise CopyException(errors)
+    return plan
+
+
+def _plan_file(src, dsts, sync, digests, src_st):
+    """ sort destinations of a file by action """
+    actions = {'create': [], 'update': [], 'skip': []}
+    for d in dsts:
+        try:
+            dst_st = os.stat(d)
+        except OSError:
+            actions['create'].append(d)
+            continue
+        if _is_uptodate(src, d, sync, digests, src_st, dst_st):
+            actions['skip'].append(d)
+        else:
+            actions['update'].append(d)
+    return actions
+
+
+def _run_plan(plan, workers=0, backends=None, digests=None, shards=0,
+              journal=None, writer=None, dedup=None):
+    """
+    Run a copy plan
+
+    :param plan: copy plan
+    :type plan: CopyPlan
+    :param workers: number of threads copying files
+    :param backends: names of copy backends to try (all by default)
+    :param digests: digest cache, to record digests of copied files
+    :type digests: DigestCache
+    :param shards: number of shards of plan run concurrently (each shard
+                   copying its files one after the other)
+    :param journal: copy journal
+    :type journal: CopyJournal
+    :param writer: safe writer
+    :type writer: SafeWriter
+    :param dedup: deduplicator
+    :type dedup: Deduplicator
+    :rtype: collections.Counter
+    """
+    logger = logging.getLogger(__name__)
+    errors = []
+    for d in plan.dirs:
+        if not os.path.isdir(d):
+            logger.debug('making dir %s', get_unicode(d, enc))
+            try:
+                os.makedirs(d)
+            except (IOError, os.error) as why:
+                errors.append((None, d, str(why)))
+
+    def run(job):
+        src, dsts = job
+        try:
+            if len(dsts) == 1:
+                return _copy(src, dsts[0], 'always', digests, None, backends,
+                             journal, writer, dedup) or 'uptodate'
+            return _copy_fanout(src, dsts, 'always', digests, None, backends,
+                                errors, journal, writer, dedup) or 'uptodate'
+        except (IOError, os.error) as why:
+            errors.extend([(src, d, str(why)) for d in dsts])
+            return 'failed'
+
+    def run_shard(shard):
+        return [run(job) for job in shard.to_copy()]
+
+    stats = collections.Counter()
+    if shards and shards > 1:
+        with ThreadPoolExecutor(max_workers=shards) as executor:
+            for results in executor.map(run_shard, plan.shard(shards)):
+                stats.update(results)
+    elif workers and workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            stats.update(executor.map(run, plan.to_copy()))
+    else:
+        stats.update([run(job) for job in plan.to_copy()])
+    stats['uptodate'] += len(
+        [f for f in plan.files if not f['create'] and not f['update']])
+    if writer is not None:
+        writer.close()
+    stats['deleted'] += _delete(plan.deletes, errors)
+    # (directories are listed in post order)
+    for src, dsts in plan.dirstats:
+        _end_dir(src, dsts, errors)
+    if errors:
+        raise CopyException(errors)
+    return stats
+
+
+def _deduplicator(mode, link_dest, digests, src):
+    """ return the deduplicator of a copy, if any """
+    if not mode and not link_dest:
+        return None
+    root = text_to_native_str(str(src))
+    if not os.path.isdir(root):
+        root = os.path.dirname(root)
+    return Deduplicator(mode or 'hardlink', digests, link_dest, root,
+                        content=bool(mode))
+
+
+def advanced_copy(src=None,
+                  dst=None,
+                  excludes=[],
+                  includes=[],
+                  recursive=True,
+                  create_directory=True,
+                  sync='content',
+                  digest_cache=None,
+                  workers=0,
+                  backends=None,
+                  fanout=False,
+                  dry_run=False,
+                  plan=None,
+                  shards=0,
+                  journal=None,
+                  atomic=False,
+                  fsync=None,
+                  dedup=None,
+                  link_dest=None,
+                  mirror=False):
+    """
+    Copy a directory structure src to destination
+    
+    :param src: source file or directory
+    :type src: string
+    :param dst: destination file or directory, or list of destinations
+    :type dst: [path,list]
+    :param excludes: list of patterns to exclude
+    :type excludes: list
+    :param includes: list of patterns to include
+    :type includes: list
+    :param recursive: recursive copy
+    :param create_directory: create missing directories
+    :param sync: strategy to decide if an existing file is up to date:
+                 'content' (same stat signature or content), 'mtime+size'
+                 (quick check), 'checksum' (same digest) or 'always'
+    :type sync: str
+    :param digest_cache: digest cache (or its filename) used by checksum
+                         strategy, so that digests of unchanged files are
+                         not computed again
+    :type digest_cache: [DigestCache,path]
+    :param workers: number of threads copying files
+    :param backends: names of copy backends to try, in 'reflink',
+                     'copy_file_range', 'sendfile', 'buffered' (all by
+                     default, in this order)
+    :type backends: list
+    :param fanout: copy to all destinations in a single walk of src, each
+                   file being read once and written to all destinations
+                   which are not up to date ('fanout' backend)
+    :param dry_run: only plan the copy and return the plan
+    :param plan: run a plan computed by `plan_copy` (or a dry run) instead
+                 of planning the copy again (src and dst are not used)
+    :type plan: CopyPlan
+    :param shards: number of shards of plan run concurrently
+    :param journal: copy journal (or its filename) recording files copied
+                    and offsets of partial copies, so that a copy run again
+                    after a failure skips the files already copied and
+                    resumes partial copies
+    :type journal: [CopyJournal,path]
+    :param atomic: copy files to temporary files (``.name.part``) renamed
+                   once complete, so that no partial file is ever seen
+    :param fsync: sync copied files to disk: None (no sync), 'file' (each
+                  file) or 'dir' (files of a directory synced together once
+                  the directory is done, then the directory)
+    :type fsync: str
+    :param dedup: link copied files to identical files already copied
+                  instead of copying them: 'hardlink' or 'reflink' (see
+                  `Deduplicator`)
+    :type dedup: str
+    :param link_dest: previous snapshots of src: unchanged files are linked
+                      to their previous copy, as rsync --link-dest (hard
+                      links by default, files are not hashed unless dedup
+                      is set too)
+    :type link_dest: [path,list]
+    :param mirror: delete destination files and directories which are not
+                   in src (files and directories excluded by patterns are
+                   kept), found in the same walk as files to copy and
+                   deleted once their directory is done ('deleted' count).
+                   Use with dry_run to review the deletions first.
+    :return: number of files by copy backend used ('uptodate' for files up
+             to date), or copy plan in a dry run
+    :rtype: [collections.Counter,CopyPlan]
+    """
+    logger = logging.getLogger(__name__)
+    if sync not in SYNC_STRATEGIES:
+        raise ValueError('unknown sync strategy %r' % sync)
+    if digest_cache is not None and not isinstance(digest_cache, DigestCache):
+        with DigestCache(digest_cache) as digest_cache:
+            return advanced_copy(src, dst, excludes, includes, recursive,
+                                 create_directory, sync, digest_cache,
+                                 workers, backends, fanout, dry_run, plan,
+                                 shards, journal, atomic, fsync, dedup,
+                                 link_dest, mirror)
+    if journal is not None and not isinstance(journal, CopyJournal):
+        with CopyJournal(journal) as journal:
+            return advanced_copy(src, dst, excludes, includes, recursive,
+                                 create_directory, sync, digest_cache,
+                                 workers, backends, fanout, dry_run, plan,
+                                 shards, journal, atomic, fsync, dedup,
+                                 link_dest, mirror)
+    if sync == 'checksum' and digest_cache is None:
+        digest_cache = DigestCache()
+    writer = SafeWriter(atomic, fsync) if atomic or fsync else None
+    if plan is not None:
+        dedup = _deduplicator(dedup, link_dest, digest_cache, plan.src)
+        try:
+            return _run_plan(plan, workers, backends, digest_cache, shards,
+                             journal, writer, dedup)
+        finally:
+            if digest_cache is not None:
+                digest_cache.flush()
+            if journal is not None:
+                journal.flush()
+    if dry_run:
+        return plan_copy(src, dst, excludes, includes, recursive,
+                         create_directory, sync, digest_cache, mirror)
+    src, dsts, includes, excludes = _prepare(src, dst, includes, excludes)
+    dedup = _deduplicator(dedup, link_dest, digest_cache, src)
+
+    stats = collections.Counter()
+    try:
+        for dst in dsts:
+            _make_dst(dst, create_directory)
+        if fanout and len(dsts) > 1:
+            logger.debug('fanout copy of %s to %s',
+                         get_unicode(str(src), enc),
+                         ', '.join([get_unicode(str(d), enc) for d in dsts]))
+            if src.is_file():
+                dstnames = [
+                    text_to_native_str(str(d.joinpath(src.name)))
+                    if d.is_dir() else text_to_native_str(str(d))
+                    for d in dsts
+                ]
+                errors = []
+                stats[_copy_fanout(src, dstnames, sync, digest_cache, None,
+                                   backends, errors, journal, writer, dedup)
+                      or 'uptodate'] += 1
+                if errors:
+                    raise CopyException(errors)
+            else:
+                stats.update(
+                    _copytree(src, dsts, excludes, includes, recursive, sync,
+                              digest_cache, workers, backends, journal,
+                              writer, dedup, mirror))
+            dsts = []
+        for dst in dsts:
+            if src.is_file():
+                logger.debug('_copy(%s,%s)', get_unicode(str(src), enc),
+                             get_unicode(str(dst), enc))
+                stats[_copy(src, dst, sync, digest_cache, None, backends,
+                            journal, writer, dedup) or 'uptodate'] += 1
+            else:
+                logger.debug('_copytree(%s,%s,...)',
+                             get_unicode(str(src), enc),
+                             get_unicode(str(dst), enc))
+                stats.update(
+                    _copytree(src, dst, excludes, includes, recursive, sync,
+                              digest_cache, workers, backends, journal,
+                              writer, dedup, mirror))
+    finally:
+        # (work done is recorded even if the copy failed)
+        if writer is not None:
+            writer.close()
+        if digest_cache is not None:
+            digest_cache.flush()
+        if journal is not None:
+            journal.flush()
+    return stats
@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""
+file content copy, using the fastest mechanism available
+
+author: Cedric ROMAN (roman@numengo.com)
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import errno
+import os
+import shutil
+import stat
+import threading
+from builtins import object
+from builtins import str
+from concurrent.futures import ThreadPoolExecutor
+
+from future.utils import text_to_native_str
+
+from .exceptions import UnsupportedCopyException
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+# size of buffer used by buffered copy
+BUFFER_SIZE = 8 * 1024 * 1024
+
+# minimum number of bytes copied between two progress reports
+PROGRESS_EVERY = 64 * 1024 * 1024
+
+# ioctl cloning a file on copy-on-write file systems (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# errors meaning a mechanism is not supported for a pair of files
+_UNSUPPORTED = set([
+    getattr(errno, e) for e in ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP',
+                                'ENOTSUP', 'ENOTTY', 'EBADF', 'EPERM',
+                                'ETXTBSY') if hasattr(errno, e)
+])
+
+
+_SameFileError = getattr(shutil, 'SameFileError', shutil.Error)
+
+
+class _Unsupported(Exception):
+    """ raised by a backend that cannot copy a file """
+
+
+def _reflink(fsrc, fdst, size, buffer_size, offset=0, progress=None):
+    if fcntl is None or offset:
+        raise _Unsupported()
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (IOError, OSError) as er:
+        if er.errno in _UNSUPPORTED:
+            raise _Unsupported()
+        raise
+
+
+class _Progress(object):
+    """ report copied offsets, once synced to disk """
+
+    def __init__(self, fdst, callback, every):
+        self.fdst = fdst
+        self.callback = callback
+        self.every = every
+        self.last = 0
+
+    def __call__(self, offset):
+        if offset - self.last >= self.every:
+            self.fdst.flush()
+            getattr(os, 'fdatasync', os.fsync)(self.fdst.fileno())
+            self.callback(offset)
+            self.last = offset
+
+
+def _copy_loop(func, fsrc, fdst, size, buffer_size, offset=0, progress=None):
+    """ copy with a kernel function, copying at most buffer_size per call """
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    start = offset
+    while offset < size:
+        try:
+            n = func(infd, outfd, offset, min(buffer_size, size - offset))
+        except OSError as er:
+            if offset == start and er.errno in _UNSUPPORTED:
+                raise _Unsupported()
+            raise
+        if n == 0:
+            if offset == start:
+                raise _Unsupported()  # file system does not support it
+            break  # file was truncated meanwhile
+        offset += n
+        if progress is not None:
+            progress(offset)
+
+
+def _copy_file_range(fsrc, fdst, size, buffer_size, offset=0, progress=None):
+    if not hasattr(os, 'copy_file_range'):
+        raise _Unsupported()
+
+    def func(infd, outfd, offset, count):
+        return os.copy_file_range(infd, outfd, count, offset, offset)
+
+    _copy_loop(func, fsrc, fdst, size, buffer_size, offset, progress)
+
+
+def _sendfile(fsrc, fdst, size, buffer_size, offset=0, progress=None):
+    if not hasattr(os, 'sendfile'):
+        raise _Unsupported()
+
+    def func(infd, outfd, offset, count):
+        # (sendfile writes at the current offset of outfd)
+        os.lseek(outfd, offset, os.SEEK_SET)
+        return os.sendfile(outfd, infd, offset, count)
+
+    _copy_loop(func, fsrc, fdst, size, buffer_size, offset, progress)
+
+
+def _buffered(fsrc, fdst, size, buffer_size, offset=0, progress=None):
+    if not offset and progress is None:
+        shutil.copyfileobj(fsrc, fdst, buffer_size)
+        return
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    for chunk in iter(lambda: fsrc.read(buffer_size), b''):
+        fdst.write(chunk)
+        offset += len(chunk)
+        if progress is not None:
+            progress(offset)
+
+
+# backends tried in order
+BACKENDS = (
+    ('reflink', _reflink),
+    ('copy_file_range', _copy_file_range),
+    ('sendfile', _sendfile),
+    ('buffered', _buffered),
+)
+
+
+def _unshare(dst):
+    """
+    Remove a destination file hard linked to other files (by a deduplicated
+    copy), so that writing it does not modify them, and return True if it
+    was removed
+    """
+    try:
+        st = os.lstat(dst)
+    except OSError:
+        return False
+    if st.st_nlink > 1 and stat.S_ISREG(st.st_mode):
+        os.remove(dst)
+        return True
+    return False
+
+
+def copyfile(src,
+             dst,
+             backends=None,
+             buffer_size=BUFFER_SIZE,
+             offset=0,
+             progress=None,
+             progress_every=PROGRESS_EVERY):
+    """
+    Copy the content of a file src to a file dst, trying in order a reflink
+    clone (FICLONE), ``os.copy_file_range``, ``os.sendfile`` and a buffered
+    copy
+
+    Kernel copies avoid copying data through user space, a reflink shares
+    data blocks between files on copy-on-write file systems.
+
+    A destination hard linked to other files is replaced by a new file,
+    never written through its links.
+
+    A copy can be resumed from an offset, the destination content before it
+    being kept. A progress callback can be given to record the offset copied
+    regularly: it is only called once the content is synced to disk.
+
+    :param src: source file
+    :type src: path
+    :param dst: destination file
+    :type dst: path
+    :param backends: names of backends to try (all by default)
+    :type backends: list
+    :param buffer_size: size of buffer (or maximum size copied by a system
+                        call)
+    :type buffer_size: int
+    :param offset: offset from which copy is resumed
+    :type offset: int
+    :param progress: function called with the offset copied
+    :type progress: callable
+    :param progress_every: minimum number of bytes copied between two calls
+                           of progress
+    :type progress_every: int
+    :return: name of the backend used
+    :rtype: str
+    :raises UnsupportedCopyException: if no backend can copy the file
+    """
+    src = text_to_native_str(str(src))
+    dst = text_to_native_str(str(dst))
+    if backends is not None:
+        unknown = set(backends).difference([n for n, _f in BACKENDS])
+        if unknown or not backends:
+            raise ValueError('unknown copy backends %s' % sorted(unknown))
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise _SameFileError('%s and %s are the same file' % (src, dst))
+    if _unshare(dst):
+        offset = 0
+    with open(src, 'rb') as fsrc:
+        size = os.fstat(fsrc.fileno()).st_size
+        offset = offset if 0 < offset <= size else 0
+        with open(dst, 'r+b' if offset else 'wb') as fdst:
+            fdst.truncate(offset)
+            if progress is not None:
+                progress = _Progress(fdst, progress, progress_every)
+            for name, func in BACKENDS:
+                if backends is not None and name not in backends:
+                    continue
+                try:
+                    func(fsrc, fdst, size, buffer_size, offset, progress)
+                    return name
+                except _Unsupported:
+                    # start again with next backend
+                    fsrc.seek(offset)
+                    fdst.seek(offset)
+                    fdst.truncate(offset)
+    raise UnsupportedCopyException('no copy backend could copy %s' % src)
+
+
+def copyfile_many(src, dsts, buffer_size=BUFFER_SIZE):
+    """
+    Copy the content of a file src to several files, reading it only once
+
+    Each chunk read is written to all destinations concurrently (in a thread
+    per destination) while the next chunk is read. A destination which
+    cannot be written is skipped, the others are still copied.
+
+    :param src: source file
+    :type src: path
+    :param dsts: destination files
+    :type dsts: list
+    :param buffer_size: size of chunks read
+    :type buffer_size: int
+    :return: errors of destinations which could not be written
+    :rtype: dict, items:{dst: error}
+    """
+    src = text_to_native_str(str(src))
+    errors = {}
+    files = []
+    for dst in dsts:
+        try:
+            if os.path.exists(dst) and os.path.samefile(src, dst):
+                raise _SameFileError('%s and %s are the same file' %
+                                     (src, dst))
+            _unshare(dst)
+            files.append((dst, open(text_to_native_str(str(dst)), 'wb')))
+        except (IOError, OSError) as er:
+            errors[dst] = er
+    executor = ThreadPoolExecutor(len(files)) if len(files) > 1 else None
+    try:
+        with open(src, 'rb') as fsrc:
+            chunk = fsrc.read(buffer_size)
+            while chunk and files:
+                if executor is None:
+                    writes = [(f, None) for f in files]
+                else:
+                    writes = [(f, executor.submit(f[1].write, chunk))
+                              for f in files]
+                # next chunk is read while current one is written
+                nxt = fsrc.read(buffer_size)
+                for f, future in writes:
+                    try:
+                        if future is None:
+                            f[1].write(chunk)
+                        else:
+                            future.result()
+                    except (IOError, OSError) as er:
+                        errors[f[0]] = er
+                        files.remove(f)
+                        f[1].close()
+                chunk = nxt
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for dst, f in files:
+            try:
+                f.close()
+            except (IOError, OSError) as er:
+                errors[dst] = er
+    return errors
+
+
+def _fsync_dir(path):
+    """ sync a directory entries to disk (not possible on windows) """
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _existing(dst):
+    """
+    Return True if a destination file exists and is written in place (not
+    removed by `_unshare` first)
+    """
+    try:
+        st = os.lstat(dst)
+    except OSError:
+        return False
+    return not (st.st_nlink > 1 and stat.S_ISREG(st.st_mode))
+
+
+class SafeWriter(object):
+    """
+    Write copied files safely
+
+    In atomic mode, a file is copied to a temporary file next to its
+    destination (``.name.part``), which is renamed to its destination once
+    complete, so that readers never see a partial file.
+
+    Durability is set by the fsync mode:
+
+    * None: nothing is synced (the system writes files back when it wants)
+    * 'file': each file is synced before being renamed, then its directory
+      (also when a file is written in place but was created, or replaced)
+    * 'dir': files are synced (and renamed) together once their directory
+      is done (see `end_dir`), then the directory is synced once: writes are
+      not stalled by each sync, while a file is still only renamed once its
+      content is on disk.
+    """
+    FSYNC_MODES = (None, 'file', 'dir')
+
+    def __init__(self, atomic=False, fsync=None):
+        """
+        :param atomic: write files to temporary files renamed once complete
+        :type atomic: bool
+        :param fsync: fsync mode (None, 'file' or 'dir')
+        :type fsync: str
+        """
+        if fsync not in self.FSYNC_MODES:
+            raise ValueError('unknown fsync mode %r' % fsync)
+        self.atomic = atomic
+        self.fsync = fsync
+        self._pending = {}
+        self._created = set()  # destinations written in place, not existing
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s atomic:%s fsync:%s>' % (self.__class__.__name__,
+                                           self.atomic, self.fsync)
+
+    def target(self, dst):
+        """
+        Return the file to write for a destination file
+
+        :param dst: destination file
+        :type dst: path
+        :rtype: path
+        """
+        dst = text_to_native_str(str(dst))
+        if not self.atomic:
+            if self.fsync == 'file' and not _existing(dst):
+                with self._lock:
+                    self._created.add(dst)
+            return dst
+        head, tail = os.path.split(dst)
+        return os.path.join(head, '.%s.part' % tail)
+
+    def commit(self, target, dst, done=None, created=False):
+        """
+        Commit a file written (with its stats) to its destination
+
+        :param target: file written, returned by `target`
+        :param dst: destination file
+        :param done: function called once the file is at its destination
+        :type done: callable
+        :param created: directory entry of dst was created (or replaced)
+                        when writing it, and must be synced too
+        :type created: bool
+        """
+        if self.fsync == 'dir':
+            with self._lock:
+                self._pending.setdefault(os.path.dirname(dst), []).append(
+                    (target, dst, done))
+            return
+        if self.fsync == 'file':
+            _fsync(target)
+            with self._lock:
+                if dst in self._created:
+                    self._created.discard(dst)
+                    created = True
+        if target != dst:
+            _replace(target, dst)
+            created = True
+        if self.fsync == 'file' and created:
+            _fsync_dir(os.path.dirname(dst) or os.curdir)
+        if done is not None:
+            done()
+
+    def end_dir(self, path):
+        """
+        Sync and rename the files pending in a directory, then sync it
+
+        :param path: destination directory
+        :type path: path
+        """
+        path = text_to_native_str(str(path))
+        with self._lock:
+            pending = self._pending.pop(path, [])
+        if not pending:
+            return
+        for target, _dst, _done in pending:
+            _fsync(target)
+        for target, dst, _done in pending:
+            if target != dst:
+                _replace(target, dst)
+        _fsync_dir(path or os.curdir)
+        for _target, _dst, done in pending:
+            if done is not None:
+                done()
+
+    def close(self):
+        """
+        Commit all pending files
+        """
+        with self._lock:
+            paths = list(self._pending)
+        for path in paths:
+            self.end_dir(path)
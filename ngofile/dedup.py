@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+deduplication of copied files, by hard links or reflinks
+
+author: Cedric ROMAN (roman@numengo.com)
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import os
+import threading
+from builtins import object
+from builtins import str
+
+from future.utils import text_to_native_str
+
+from .copyfile import copyfile
+from .digests import DigestCache
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+class Deduplicator(object):
+    """
+    Link copied files to identical files instead of copying them
+
+    A file is linked:
+
+    * to the same file in a previous snapshot (as rsync ``--link-dest``), if
+      it has the same size and modification time as its source
+    * to a file with the same content already copied, found by the digests
+      of sources (cached by inode, size and modification time, see
+      `DigestCache`)
+
+    Files are linked by hard links (all links share their stats, those of
+    the first copy) or by reflinks (each file has its own stats, only data
+    blocks are shared, on copy-on-write file systems). A file which cannot
+    be linked is copied.
+    """
+    MODES = ('hardlink', 'reflink')
+
+    def __init__(self, mode='hardlink', digests=None, link_dest=None,
+                 root=None, content=True):
+        """
+        :param mode: 'hardlink' or 'reflink'
+        :param digests: digest cache of sources
+        :type digests: DigestCache
+        :param link_dest: previous snapshots, with the same layout as the
+                          source directory
+        :type link_dest: [path,list]
+        :param root: source directory, to find files in previous snapshots
+        :type root: path
+        :param content: link files with the same content (sources are
+                        hashed), otherwise only files of previous snapshots
+                        are linked
+        :type content: bool
+        """
+        if mode not in self.MODES:
+            raise ValueError('unknown dedup mode %r' % mode)
+        self.mode = mode
+        self.content = content
+        if content and digests is None:
+            digests = DigestCache()
+        self.digests = digests
+        link_dest = link_dest or []
+        link_dest = link_dest if isinstance(link_dest, list) else [link_dest]
+        self.link_dest = [text_to_native_str(str(d)) for d in link_dest]
+        self.root = text_to_native_str(str(root)) if root else None
+        self.bytes_saved = 0
+        self._contents = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s %s (%i bytes saved)>' % (self.__class__.__name__,
+                                             self.mode, self.bytes_saved)
+
+    def _previous(self, src, src_st):
+        """ return same file in previous snapshots, if unchanged """
+        if self.root is None:
+            return None
+        rel = os.path.relpath(src, self.root)
+        for d in self.link_dest:
+            prev = os.path.join(d, rel)
+            try:
+                st = os.stat(prev)
+            except OSError:
+                continue
+            if (st.st_size == src_st.st_size
+                    and int(st.st_mtime) == int(src_st.st_mtime)):
+                return prev
+        return None
+
+    def _same_content(self, src, src_st):
+        """ return file copied with the same content, if any """
+        key = (src_st.st_size, self.digests.digest(src, src_st))
+        with self._lock:
+            origin = self._contents.get(key)
+        if origin is not None and os.path.exists(origin):
+            return origin
+        return None
+
+    def link(self, src, dst, src_st=None):
+        """
+        Link a destination file to a file identical to its source
+
+        :param src: source file
+        :param dst: destination file
+        :param src_st: stat result of source file, if already known
+        :return: mode used, None if no identical file could be linked
+        :rtype: str
+        """
+        src = text_to_native_str(str(src))
+        dst = text_to_native_str(str(dst))
+        src_st = src_st or os.stat(src)
+        origin = self._previous(src, src_st)
+        if origin is None and self.content:
+            origin = self._same_content(src, src_st)
+        if origin is None:
+            return None
+        head, tail = os.path.split(dst)
+        tmp = os.path.join(head, '.%s.link' % tail)
+        try:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            if self.mode == 'hardlink':
+                os.link(origin, tmp)
+            else:
+                copyfile(origin, tmp, ['reflink'])
+                os.utime(tmp, (src_st.st_atime, src_st.st_mtime))
+                os.chmod(tmp, src_st.st_mode & 0o7777)
+            _replace(tmp, dst)
+        except (IOError, OSError):
+            # (other file system, too many links, no copy-on-write...)
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            return None
+        with self._lock:
+            self.bytes_saved += src_st.st_size
+        return self.mode
+
+    def add(self, src, dst, src_st=None):
+        """
+        Record a file copied, to link the next files with the same content
+
+        :param src: source file
+        :param dst: destination file
+        :param src_st: stat result of source file, if already known
+        """
+        if not self.content:
+            return
+        src = text_to_native_str(str(src))
+        src_st = src_st or os.stat(src)
+        key = (src_st.st_size, self.digests.digest(src, src_st))
+        with self._lock:
+            self._contents.setdefault(key, text_to_native_str(str(dst)))
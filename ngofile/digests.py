@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+persistent cache of file digests
+
+author: Cedric ROMAN (roman@numengo.com)
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import time
+from builtins import str
+
+from future.utils import text_to_native_str
+
+from .index import RACY_DELAY
+from .index import _SqliteStore
+
+# size of blocks read to compute digests
+BLOCK_SIZE = 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    inode INTEGER NOT NULL,
+    ctime REAL NOT NULL,
+    digest TEXT NOT NULL
+)
+"""
+
+
+def file_digest(path, algorithm='sha1'):
+    """
+    Compute the digest of a file content
+
+    :param path: file path
+    :type path: path
+    :param algorithm: hashlib algorithm
+    :rtype: str
+    """
+    h = hashlib.new(algorithm)
+    with open(text_to_native_str(str(path)), 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class DigestCache(_SqliteStore):
+    """
+    Digests of file contents, stored in a sqlite database
+
+    A digest is computed again only when the size, modification time, inode
+    or status change time of its file changed (the latter detects contents
+    rewritten with their modification time restored), so that checking an
+    unchanged tree only costs a stat call per file.
+    """
+
+    def __init__(self, filename=':memory:', algorithm='sha1'):
+        """
+        Open (or create) a digest cache database
+
+        :param filename: filename of database
+        :type filename: path
+        :param algorithm: hashlib algorithm used to compute digests
+        :type algorithm: str
+        """
+        _SqliteStore.__init__(self, filename, _SCHEMA)
+        self.algorithm = algorithm
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, path, st=None):
+        """
+        Return the digest of a file, computing it only if the file changed
+
+        :param path: file path
+        :type path: path
+        :param st: stat result of file, if already known
+        :rtype: str
+        """
+        path = os.path.abspath(text_to_native_str(str(path)))
+        st = st or os.stat(path)
+        sig = (st.st_size, st.st_mtime, st.st_ino, st.st_ctime)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime, inode, ctime, digest FROM digests '
+                'WHERE path=?', (path, )).fetchone()
+            if row and tuple(row[:4]) == sig:
+                self.hits += 1
+                return row[4]
+            self.misses += 1
+        digest = file_digest(path, self.algorithm)
+        self.set(path, st, digest)
+        return digest
+
+    def set(self, path, st, digest):
+        """
+        Store the digest of a file with its stat result
+
+        Files modified too recently to be trusted (they might be modified
+        again within the same mtime tick) are not stored.
+
+        :param path: file path
+        :type path: path
+        :param st: stat result of file
+        :param digest: digest of file content
+        :type digest: str
+        """
+        if time.time() - st.st_mtime < RACY_DELAY:
+            return
+        path = os.path.abspath(text_to_native_str(str(path)))
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)',
+                (path, st.st_size, st.st_mtime, st.st_ino, st.st_ctime,
+                 digest))
+            self._changed()
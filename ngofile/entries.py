@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+light directory entries used in file listings
+
+author: Cedric ROMAN (roman@numengo.com)
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import os
+import os.path
+import stat
+from builtins import object
+from builtins import str
+
+from future.utils import text_to_native_str
+
+
+class FileEntry(object):
+    """
+    Light wrapper around a path with the interface of ``os.DirEntry``
+
+    It is used where no ``os.DirEntry`` is available (a file given as source,
+    a parent directory, etc...). The stat result is cached after the first
+    call, as ``os.DirEntry`` does.
+    """
+    __slots__ = ('name', 'path', '_stat', '_lstat')
+
+    def __init__(self, path, stat=None):
+        self.path = text_to_native_str(str(path))
+        self.name = os.path.basename(self.path.rstrip('/\\')) or self.path
+        self._stat = stat
+        self._lstat = None
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.name)
+
+    def __fspath__(self):
+        return self.path
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks:
+            if self._lstat is None:
+                self._lstat = os.lstat(self.path)
+            return self._lstat
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(False).st_mode)
+        except OSError:
+            return False
+
+    def inode(self):
+        return self.stat(False).st_ino
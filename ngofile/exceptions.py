@@ -20,6 +20,12 @@ class CopyException(NgoFileException):
     """
 
 
+class UnsupportedCopyException(NgoFileException, IOError):
+    """
+    Raised when no copy backend can copy a file
+    """
+
+
 class NotExistingPathException(NgoFileException, IOError):
     """
     Raised when a path does not exist
@@ -42,7 +48,13 @@ class NotADirectoryException(NgoFileException, ValueError):
         super(NotADirectoryException, self).__init__(message)
 
 
-class NotAZipArchiveException(NgoFileException, ValueError):
+class NotAnArchiveException(NgoFileException, ValueError):
+    """
+    Raised when the object given is not a supported archive
+    """
+
+
+class NotAZipArchiveException(NotAnArchiveException):
     """
     Raised when the object given is not a zipfile
     """
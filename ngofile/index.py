@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+persistent index of directory listings
+
+author: Cedric ROMAN (roman@numengo.com)
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+import time
+from builtins import object
+from builtins import str
+
+from future.utils import text_to_native_str
+
+from .entries import FileEntry
+
+try:
+    from os import scandir
+except ImportError:  # python < 3.5
+    from scandir import scandir
+
+logger = logging.getLogger(__name__)
+
+# directories modified less than this delay (in seconds) before being read
+# might be modified again within the same mtime tick: they are read again
+RACY_DELAY = 2.
+
+# number of directory updates after which changes are committed
+COMMIT_EVERY = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    scanned REAL NOT NULL,
+    names TEXT NOT NULL,
+    types TEXT NOT NULL
+)
+"""
+
+
+class _SqliteStore(object):
+    """
+    Base class of objects stored in a sqlite database, whose changes are
+    committed in batches
+    """
+
+    def __init__(self, filename, schema):
+        """
+        Open (or create) a database
+
+        :param filename: filename of database
+        :type filename: path
+        :param schema: sql script creating tables
+        :type schema: str
+        """
+        self.filename = text_to_native_str(str(filename))
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        if self.filename != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(schema)
+        self._db.commit()
+        self._changes = 0
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def flush(self):
+        """
+        Commit pending changes to database
+        """
+        with self._lock:
+            if self._changes:
+                self._db.commit()
+                self._changes = 0
+
+    def close(self):
+        """
+        Commit pending changes and close database
+        """
+        with self._lock:
+            self.flush()
+            self._db.close()
+
+    def _changed(self):
+        # count a change, changes being committed every COMMIT_EVERY
+        with self._lock:
+            self._changes += 1
+            if self._changes >= COMMIT_EVERY:
+                self.flush()
+
+
+class IndexEntry(FileEntry):
+    """
+    Directory entry read from a listing index
+
+    Its type is known from the index, its stat result is only read on demand.
+    """
+    __slots__ = ('_is_dir', )
+
+    def __init__(self, path, is_dir):
+        FileEntry.__init__(self, path)
+        self._is_dir = is_dir
+
+    def is_dir(self, follow_symlinks=True):
+        if follow_symlinks:
+            return self._is_dir
+        return FileEntry.is_dir(self, follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        if follow_symlinks and self._is_dir:
+            return False
+        return FileEntry.is_file(self, follow_symlinks)
+
+
+class ListingIndex(_SqliteStore):
+    """
+    On-disk index of directory listings, stored in a sqlite database
+
+    Each directory listed through the index is stored with its entries and
+    its modification time. It is read again from disk only when its
+    modification time changed, which only costs a stat call per directory
+    for an unchanged tree.
+
+    Directories are keyed by their path, so an index can be shared by
+    several roots.
+    """
+
+    def __init__(self, filename=':memory:'):
+        """
+        Open (or create) an index database
+
+        :param filename: filename of database
+        :type filename: path
+        """
+        _SqliteStore.__init__(self, filename, _SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def scandir(self, path):
+        """
+        List a directory, reading it from disk only if it changed
+
+        :param path: directory to list
+        :type path: str
+        :rtype: list, items:{type: IndexEntry}
+        """
+        path = text_to_native_str(str(path))
+        mtime = os.stat(path).st_mtime
+        with self._lock:
+            row = self._db.execute(
+                'SELECT mtime, scanned, names, types FROM dirs WHERE path=?',
+                (path, )).fetchone()
+            fresh = row and row[0] == mtime and row[1] - mtime > RACY_DELAY
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if fresh:
+            if not row[2]:
+                return []
+            return [
+                IndexEntry(os.path.join(path, n), t == 'd')
+                for n, t in zip(row[2].split('/'), row[3])
+            ]
+        logger.debug('reading modified directory %s', path)
+        scanned = time.time()
+        entries = [
+            IndexEntry(e.path, e.is_dir()) for e in scandir(path)
+        ]
+        names = '/'.join([e.name for e in entries])
+        types = ''.join(['d' if e._is_dir else 'f' for e in entries])
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)',
+                (path, mtime, scanned, names, types))
+            self._changed()
+        return entries
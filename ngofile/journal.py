@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+journal of a copy, to resume it where it stopped
+
+author: Cedric ROMAN (roman@numengo.com)
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import os
+from builtins import str
+
+from future.utils import text_to_native_str
+
+from .index import _SqliteStore
+
+# offset recorded for completed files
+DONE = -1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    dst TEXT PRIMARY KEY,
+    src TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    dst_mtime REAL,
+    offset INTEGER NOT NULL
+)
+"""
+
+
+class CopyJournal(_SqliteStore):
+    """
+    Journal of the destination files of a copy, stored in a sqlite database
+
+    Each destination file is recorded with the size and modification time of
+    its source, and either as completed or with the offset up to which its
+    content is copied (and synced to disk). A copy run again with the same
+    journal skips completed files without comparing them, and resumes
+    partial files at their offset, as long as their source did not change.
+
+    Completed files are committed in batches: those lost in a crash are only
+    compared again with their source.
+    """
+
+    def __init__(self, filename=':memory:'):
+        """
+        Open (or create) a copy journal
+
+        :param filename: filename of journal database
+        :type filename: path
+        """
+        _SqliteStore.__init__(self, filename, _SCHEMA)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM journal WHERE offset=?',
+                (DONE, )).fetchone()[0]
+
+    def _get(self, dst, src_st):
+        dst = os.path.abspath(text_to_native_str(str(dst)))
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime, dst_mtime, offset FROM journal '
+                'WHERE dst=?', (dst, )).fetchone()
+        if row and (row[0], row[1]) == (src_st.st_size, src_st.st_mtime):
+            return row
+        return None
+
+    def is_done(self, dst, src_st):
+        """
+        Return True if a destination file was completely copied from its
+        source, and neither changed since
+
+        :param dst: destination file
+        :type dst: path
+        :param src_st: stat result of source file
+        :rtype: bool
+        """
+        row = self._get(dst, src_st)
+        if row is None or row[3] != DONE:
+            return False
+        try:
+            dst_st = os.stat(text_to_native_str(str(dst)))
+        except OSError:
+            return False
+        return (dst_st.st_size, dst_st.st_mtime) == (row[0], row[2])
+
+    def offset(self, dst, src_st):
+        """
+        Return the offset from which copy of a partial destination file can
+        be resumed (0 if it cannot)
+
+        :param dst: destination file
+        :type dst: path
+        :param src_st: stat result of source file
+        :rtype: int
+        """
+        row = self._get(dst, src_st)
+        if row is None or row[3] <= 0:
+            return 0
+        try:
+            size = os.path.getsize(text_to_native_str(str(dst)))
+        except OSError:
+            return 0
+        return row[3] if size >= row[3] else 0
+
+    def _set(self, src, dst, src_st, dst_mtime, offset):
+        dst = os.path.abspath(text_to_native_str(str(dst)))
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?)',
+                (dst, text_to_native_str(str(src)), src_st.st_size,
+                 src_st.st_mtime, dst_mtime, offset))
+            self._changed()
+
+    def set_offset(self, src, dst, src_st, offset):
+        """
+        Record the offset up to which a destination file content is copied
+        and synced (committed immediately)
+
+        :param src: source file
+        :param dst: destination file
+        :param src_st: stat result of source file
+        :param offset: number of bytes copied
+        :type offset: int
+        """
+        with self._lock:
+            self._set(src, dst, src_st, None, offset)
+            self.flush()
+
+    def set_done(self, src, dst, src_st):
+        """
+        Record a destination file as completely copied
+
+        :param src: source file
+        :param dst: destination file
+        :param src_st: stat result of source file
+        """
+        dst_st = os.stat(text_to_native_str(str(dst)))
+        self._set(src, dst, src_st, dst_st.st_mtime, DONE)
@@ -7,36 +7,56 @@ licence: GNU GPLv3
 """
 from __future__ import unicode_literals
 
-import fnmatch
 import logging
 import os
 import os.path
 import pathlib
-import re
+import queue
+import sys
+import threading
 import zipfile
-from builtins import range
 from builtins import str
+from concurrent.futures import ThreadPoolExecutor
 
 from future.utils import text_to_native_str
 
+try:
+    from os import scandir
+except ImportError:  # python < 3.5
+    from scandir import scandir
+
+from .archives import ARCHIVE_SEP
+from .archives import ArchiveIndex
+from .archives import is_archive
+from .entries import FileEntry
 from .exceptions import NotADirectoryException
 from .exceptions import NotAZipArchiveException
 from .exceptions import NotExistingPathException
+from .index import ListingIndex
+from .patterns import PatternSet
+from .patterns import split_pattern
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING)
 
 
-def yield_files(src,
-               includes=["*"],
-               excludes=[],
-               recursive=False,
-               in_parents=False,
-               folders=0):
+def yield_entries(src,
+                  includes=["*"],
+                  excludes=[],
+                  recursive=False,
+                  in_parents=False,
+                  folders=0,
+                  workers=0,
+                  ordered=False,
+                  index=None,
+                  into_archives=False):
     """
-    List files in a source path with a list of given patterns
+    List directory entries in a source path with a list of given patterns
 
-    if src contains patterns, modifies initial source dir and create corresponding includes patterns
+    Same as `yield_files` but yields the ``os.DirEntry`` objects obtained
+    with ``os.scandir`` (or a `FileEntry` when none is available), so that
+    callers can use their cached type and stat information (size, mtime,
+    etc...) without an extra stat call.
 
     :param src: source directory
     :type src: str
@@ -48,167 +68,384 @@ def yield_files(src,
     :param in_parents: list files recursively in parents
     :param folders: 0: without folders, 1: with folders, 2: only folders
     :type folders: enum:[0,1,2]
-    :rtype: path
+    :param workers: number of threads used to read directories (serial
+                    listing if 0 or 1)
+    :param ordered: with workers, yield entries in the same order as a
+                    serial listing
+    :param index: listing index (or its filename) used to read only
+                  directories modified since last listing
+    :type index: [ListingIndex,WatchedListing,path]
+    :param into_archives: list archives members as if archives were
+                          directories, with virtual paths such as
+                          ``a/b.zip!/inner/x.py``
+    :rtype: os.DirEntry
     """
     if type(src) in [list, set, tuple]:
         for s in src:
-            for f in list_files(s, includes, excludes, recursive, in_parents,
-                                folders):
-                yield f
+            for e in yield_entries(s, includes, excludes, recursive,
+                                   in_parents, folders, workers, ordered,
+                                   index, into_archives):
+                yield e
         return
 
-    # declare includes regex and create a function to compile it
-    global inclp
-    inclp = None
-
-    def _compile_includes(includes):
-        global inclp
-        incl = r'|'.join([fnmatch.translate(x) for x in includes])
-        inclp = re.compile(incl, re.IGNORECASE)
-
-    # declare excludes regex and create a function to compile it
-    global exclp
-    exclp = None
-
-    def _compile_excludes(excludes):
-        global exclp
-        excl = r'|'.join([fnmatch.translate(x)
-                          for x in excludes]) or r'$.'
-        exclp = re.compile(excl, re.IGNORECASE)
-
-    # global counters
-    global f_count
-    global d_count
-    f_count = 0
-    d_count = 0
-
-    # first we define a helper function for recursive operations
-    def list_files_in_dir(srcdir, includes, excludes, recursive):
-        """ we use strings and only create a path object if it s a resut """
-        global inclp, exclp
-        global d_count
-        lf_count = 0  # local file counter
-        ld_count = 0  # local inner directory counter
-        for p in includes:
-            p2 = p.replace('\\', '/')
-            if '/' in p2:
-                includes2 = set(includes)
-                pa, pb = p2.split('/', 1)
-                includes2.remove(p)
-                includes2.add(pb)
-                pa = os.path.join(srcdir, pa)
-                if os.path.exists(pa):
-                    ld_count += 1
-                    _compile_includes(includes2)
-                    for f in list_files_in_dir(pa, includes2, excludes,
-                                               recursive):
-                        lf_count += 1
-                        yield f
-                    _compile_includes(includes)
-
-        for p in excludes:
-            p2 = p.replace('\\', '/')
-            # deal with absolute path
-            if p2.startswith(srcdir):
-                p2 = str(pathlib.Path(p2).relative_to(srcdir))
-            if '/' in p2:
-                excludes2 = set(excludes)
-                pa, pb = p2.split('/', 1)
-                excludes2.remove(p)
-                excludes2.add(pb)
-                pa = os.path.join(srcdir, pa)
-                if os.path.exists(pa):
-                    ld_count += 1
-                    _compile_excludes(excludes2)
-                    for f in list_files_in_dir(pa, includes, excludes2,
-                                               recursive):
-                        lf_count += 1
-                        yield f
-                    _compile_excludes(excludes)
-        names_all = os.listdir(srcdir)
-        names_not_excl = [
-            name for name in names_all if not exclp.match(name)
-        ]
-        for name in names_not_excl:
-            path = os.path.join(srcdir, name)
-            is_dir = os.path.isdir(path)
-            if os.path.isdir(path) and recursive:
-                for f in list_files_in_dir(path, includes, excludes,
-                                           recursive):
-                    lf_count += 1
-                    yield pathlib.Path(f)
-            if inclp.match(name):
-                if ((folders == 0 and not is_dir) or (folders == 1)
-                        or (folders == 2 and is_dir)):
-                    lf_count += 1
-                    yield pathlib.Path(path)
-
-        d_count += ld_count
-        logger.debug('found %i files in %s (and %i inner directories)',
-                     lf_count, srcdir, ld_count)
-
-    src = text_to_native_str(str(src))
-    # treat case src is given as a pattern and does not really exist,
-    # convert it to an include
-    if '*' in src:
-        src = src.replace('\\', '/')
-        bf, af = src.split('*', 1)
-        src, inc = bf.rsplit('/', 1)
-        inc = '%s*%s' % (inc, af)
-        includes.add(inc)
+    src, includes = _split_src(src, includes)
     if not os.path.exists(src):
         raise IOError('impossible to list file in non existing directory %s',
                       src)
     if not os.path.isdir(src):  # it s a file, returns it
-        yield pathlib.Path(src)
+        yield FileEntry(src)
+        return
+
+    # patterns are compiled once and shared by all the directories listed
+    patterns = PatternSet.compile(includes, excludes)
+
+    if index is not None and not hasattr(index, 'scandir'):
+        with ListingIndex(index) as index:
+            for e in yield_entries(src, patterns, None, recursive,
+                                   in_parents, folders, workers, ordered,
+                                   index, into_archives):
+                yield e
         return
+    lister = index.scandir if index is not None else scandir
+    if into_archives:
+        lister = _archive_lister(lister)
 
-    # to compile regexp only when they change
-    if not isinstance(includes, list):
-        includes = [includes]
-    if not isinstance(excludes, list):
-        excludes = [excludes]
-    # this creates a set of all includes/excludes in native string
-    includes = set([text_to_native_str(i) for i in includes])
-    excludes = set([text_to_native_str(e) for e in excludes])
-    _compile_includes(includes)
-    _compile_excludes(excludes)
+    for srcdir, patterns2, in_parent in _roots(src, patterns, in_parents):
+        counts = [0, 0]  # files and inner directories counters
+        for e in _walk(srcdir, patterns2, recursive, folders, counts,
+                       workers, ordered, lister, into_archives):
+            yield e
+        _log_counts(srcdir, counts, in_parent)
+    if index is not None:
+        index.flush()
 
-    for f in list_files_in_dir(src, includes, excludes, recursive):
-        f_count += 1
-        yield pathlib.Path(f)
 
-    logger.info('found %i files in %s (and %i inner directories)', f_count,
-                src, d_count)
+def _split_src(src, includes):
+    """
+    Return source directory and includes, converting a source given as a
+    pattern (which does not really exist) to an include relative to its
+    literal base directory
+    """
+    src = text_to_native_str(str(src))
+    if '*' in src:
+        src, inc = split_pattern(src)
+        src = src or '.'
+        if not isinstance(includes, (list, set, tuple)):
+            includes = [includes]
+        # default includes would select everything
+        includes = [i for i in includes if i != '*'] + [inc]
+    return src, includes
+
 
+def _roots(src, patterns, in_parents):
+    """
+    Yield directories to walk with their patterns: the source directory and
+    its parents (excluding the child already listed) if in_parents
+    """
+    yield src, patterns, False
     if in_parents:
         srcdir = pathlib.Path(src)
         cur = srcdir.resolve()
         while cur.stem:
-            f_count = 0
-            d_count = 0
-            excludes2 = excludes.union(set([cur.relative_to(cur.parent)]))
-            excludes2 = set([text_to_native_str(str(e)) for e in excludes2])
-            for f in list_files_in_dir(
-                    text_to_native_str(str(cur.parent)), includes, excludes2,
-                    recursive):
-                f_count += 1
-                yield pathlib.Path(f)
-            if f_count:
-                logger.info(
-                    'found %i files in parents in %s (and %i inner directories)',
-                    f_count, cur.parent, d_count)
+            # exclude the directory already listed
+            patterns2 = patterns.with_excludes(text_to_native_str(str(cur)))
+            yield text_to_native_str(str(cur.parent)), patterns2, True
             cur = cur.parent
 
 
+def _log_counts(srcdir, counts, in_parent=False):
+    if not in_parent:
+        logger.info('found %i files in %s (and %i inner directories)',
+                    counts[0], srcdir, counts[1])
+    elif counts[0]:
+        logger.info(
+            'found %i files in parents in %s (and %i inner directories)',
+            counts[0], srcdir, counts[1])
+
+
+def _scan_dir(srcdir,
+              patterns,
+              recursive,
+              folders,
+              lister=scandir,
+              into_archives=False):
+    """
+    Scan a directory and return the items to process, in listing order
+
+    An item is either an entry to yield, or a tuple (directory, patterns) of
+    a sub directory to walk. Excluded sub directories are pruned and never
+    read. All state is local or given as parameter, so that several
+    directories can be scanned concurrently.
+
+    :param srcdir: directory to list
+    :type srcdir: str
+    :param patterns: compiled patterns, in the state of this directory
+    :type patterns: PatternSet
+    :param recursive: list files recursively
+    :param folders: 0: without folders, 1: with folders, 2: only folders
+    :param lister: function listing the entries of a directory
+    :param into_archives: walk archives as directories
+    :rtype: list
+    """
+    items = []
+    # entries are listed at once to release the directory handle before
+    # recursing, their type is cached and costs no extra stat call
+    entries_all = list(lister(srcdir))
+    entries_not_excl = [
+        entry for entry in entries_all
+        if not patterns.exclude(entry.name, entry.path)
+    ]
+    for entry in entries_not_excl:
+        is_dir = entry.is_dir()
+        if is_dir:
+            patterns2 = patterns.descend(entry.name, recursive)
+            if patterns2 is not None:
+                items.append((entry.path, patterns2))
+        elif (into_archives and is_archive(entry.name)
+              and ARCHIVE_SEP not in srcdir):
+            # archive is walked as a directory, it is only opened when read
+            # (nested archives are not)
+            patterns2 = patterns.descend(entry.name, recursive)
+            if patterns2 is not None:
+                items.append((entry.path + ARCHIVE_SEP, patterns2))
+        if patterns.include(entry.name):
+            if ((folders == 0 and not is_dir) or (folders == 1)
+                    or (folders == 2 and is_dir)):
+                items.append(entry)
+    return items
+
+
+def _archive_lister(lister):
+    """
+    Return a lister function also listing the virtual directories of archives
+    """
+
+    def scan(path):
+        archive, sep, inner = path.partition(ARCHIVE_SEP)
+        if sep and is_archive(archive):
+            # archives which cannot be read are only warned about once
+            index = ArchiveIndex.get(archive, quiet=True)
+            if index is None:
+                return []
+            return index.scandir(inner, archive + ARCHIVE_SEP)
+        return lister(path)
+
+    return scan
+
+
+def _walk(srcdir,
+          patterns,
+          recursive,
+          folders,
+          counts,
+          workers=0,
+          ordered=False,
+          lister=scandir,
+          into_archives=False):
+    """
+    Yield entries of a directory matching a compiled pattern set
+
+    :param srcdir: directory to list
+    :type srcdir: str
+    :param patterns: compiled patterns
+    :type patterns: PatternSet
+    :param recursive: list files recursively
+    :param folders: 0: without folders, 1: with folders, 2: only folders
+    :param counts: files and inner directories counters, updated in place
+    :type counts: list
+    :param workers: number of threads used to read directories
+    :param ordered: yield entries in the same order as a serial listing
+    :param lister: function listing the entries of a directory
+    :param into_archives: walk archives as directories
+    """
+    if workers and workers > 1:
+        if ordered:
+            walker = _walk_parallel_ordered
+        else:
+            walker = _walk_parallel
+        for e in walker(srcdir, patterns, recursive, folders, counts,
+                        workers, lister=lister, into_archives=into_archives):
+            yield e
+        return
+    items = _scan_dir(srcdir, patterns, recursive, folders, lister,
+                      into_archives)
+    lf_count = 0  # local file counter
+    for item in items:
+        if isinstance(item, tuple):
+            counts[1] += 1
+            for e in _walk(item[0], item[1], recursive, folders, counts,
+                           lister=lister, into_archives=into_archives):
+                yield e
+        else:
+            lf_count += 1
+            counts[0] += 1
+            yield item
+    logger.debug('found %i files in %s', lf_count, srcdir)
+
+
+def _walk_parallel(srcdir, patterns, recursive, folders, counts, workers,
+                   queue_size=None, lister=scandir, into_archives=False):
+    """
+    Yield entries of a directory, reading sub directories in a thread pool
+
+    Directories are scanned by workers which put their results in a bounded
+    queue, entries are yielded as soon as their directory is read, in no
+    particular order.
+
+    :param workers: number of threads used to read directories
+    :param queue_size: maximum number of scanned directories waiting to be
+                       consumed (default to 4 times the number of workers)
+    """
+    results = queue.Queue(maxsize=queue_size or 4 * workers)
+    stop = threading.Event()
+
+    def scan(path, patterns):
+        if stop.is_set():
+            return
+        try:
+            items = _scan_dir(path, patterns, recursive, folders, lister,
+                              into_archives)
+        except Exception as er:  # reraised in consumer thread
+            items = er
+        while not stop.is_set():
+            try:
+                results.put((path, items), timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        executor.submit(scan, srcdir, patterns)
+        pending = 1
+        while pending:
+            path, items = results.get()
+            pending -= 1
+            if isinstance(items, Exception):
+                raise items
+            lf_count = 0
+            for item in items:
+                if isinstance(item, tuple):
+                    counts[1] += 1
+                    pending += 1
+                    executor.submit(scan, *item)
+                else:
+                    lf_count += 1
+                    counts[0] += 1
+                    yield item
+            logger.debug('found %i files in %s', lf_count, path)
+    finally:
+        # release workers if the generator is not exhausted
+        stop.set()
+        executor.shutdown(wait=False)
+
+
+def _walk_parallel_ordered(srcdir, patterns, recursive, folders, counts,
+                           workers, prefetch=None, lister=scandir,
+                           into_archives=False):
+    """
+    Yield entries of a directory, reading sub directories in a thread pool
+
+    Entries are yielded in the same order as a serial listing. Sub
+    directories are read ahead by workers as soon as their parent is read,
+    with at most `prefetch` directories read in advance.
+
+    :param workers: number of threads used to read directories
+    :param prefetch: maximum number of directories read in advance (default
+                     to 4 times the number of workers)
+    """
+    prefetch = prefetch or 4 * workers
+    executor = ThreadPoolExecutor(max_workers=workers)
+    inflight = [0]
+
+    def submit(item):
+        inflight[0] += 1
+        return executor.submit(_scan_dir, item[0], item[1], recursive,
+                               folders, lister, into_archives)
+
+    def walk(path, future):
+        items = future.result()
+        inflight[0] -= 1
+        # read ahead sub directories
+        futures = {}
+        for i, item in enumerate(items):
+            if isinstance(item, tuple) and inflight[0] < prefetch:
+                futures[i] = submit(item)
+        lf_count = 0
+        for i, item in enumerate(items):
+            if isinstance(item, tuple):
+                counts[1] += 1
+                future = futures.get(i) or submit(item)
+                for e in walk(item[0], future):
+                    yield e
+            else:
+                lf_count += 1
+                counts[0] += 1
+                yield item
+        logger.debug('found %i files in %s', lf_count, path)
+
+    try:
+        for e in walk(srcdir, submit((srcdir, patterns))):
+            yield e
+    finally:
+        executor.shutdown(wait=False)
+
+
+def yield_files(src,
+               includes=["*"],
+               excludes=[],
+               recursive=False,
+               in_parents=False,
+               folders=0,
+               workers=0,
+               ordered=False,
+               index=None,
+               into_archives=False):
+    """
+    List files in a source path with a list of given patterns
+
+    if src contains patterns, modifies initial source dir and create corresponding includes patterns
+
+    :param src: source directory
+    :type src: str
+    :param includes: pattern or list of patterns (*.py, *.txt, etc...)
+    :type includes: [str,list]
+    :param excludes: pattern or patterns to exclude
+    :type excludes: [str,list]
+    :param recursive: list files recursively
+    :param in_parents: list files recursively in parents
+    :param folders: 0: without folders, 1: with folders, 2: only folders
+    :type folders: enum:[0,1,2]
+    :param workers: number of threads used to read directories (serial
+                    listing if 0 or 1)
+    :param ordered: with workers, yield files in the same order as a serial
+                    listing
+    :param index: listing index (or its filename) used to read only
+                  directories modified since last listing
+    :type index: [ListingIndex,WatchedListing,path]
+    :param into_archives: list archives members as if archives were
+                          directories, with virtual paths such as
+                          ``a/b.zip!/inner/x.py``
+    :rtype: path
+    """
+    for e in yield_entries(src, includes, excludes, recursive, in_parents,
+                           folders, workers, ordered, index, into_archives):
+        yield pathlib.Path(e.path)
+
+
 def list_files(src,
                includes=["*"],
                excludes=[],
                recursive=False,
                in_parents=False,
-               folders=0):
+               folders=0,
+               workers=0,
+               ordered=False,
+               index=None,
+               into_archives=False):
     __doc__ = yield_files.__doc__
-    return list(yield_files(src, includes, excludes, recursive, in_parents, folders))
+    return list(yield_files(src, includes, excludes, recursive, in_parents, folders,
+                            workers, ordered, index, into_archives))
 
 
 def yield_files_in_zip(archive,
@@ -219,6 +456,10 @@ def yield_files_in_zip(archive,
     """
     List files in a zip file
 
+    Include patterns are matched against member paths, in a recursive
+    listing wildcards also match the path separator. Directories matched
+    select their content.
+
     :param archive: zipfile to explore
     :type archive: zipfile.ZipFile
     :param includes: pattern or list of patterns ('*.py', '*.txt', etc...)
@@ -229,33 +470,12 @@ def yield_files_in_zip(archive,
     :param directories: list also directories (NOT IMPLEMENTED)
     :rtype: list
     """
-    if not isinstance(includes, list):
-        includes = [includes]
-    includes = [i.replace('\\', '/') for i in includes]
     if not isinstance(archive, zipfile.ZipFile):
         raise NotAZipArchiveException('%r is not a valid zip file' % archive)
-    dirs = set()
-    for d in [
-            re.match('(.*)/[^/]*$', l).group(1) for l in archive.namelist()
-            if re.match('(.*)/[^/]*$', l)
-    ]:
-        dirs.add(d)
-        for i in range(len(d.split('/'))):
-            dirs.add('/'.join(d.split('/')[0:i]))
-    incl = r'|'.join([fnmatch.translate(x) for x in includes])
-    excl = r'|'.join([fnmatch.translate(x) for x in excludes]) or r'$.'
-    if len([x for x in dirs if re.match(incl, x)]):
-        incl = incl.replace(
-            '\Z(?ms)', r'\/.*\Z(?ms)'
-        )  #http://stackoverflow.com/questions/11998613/regular-expression-zms
-        incl = incl.replace('$', r'\/.*$')
-    if not recursive:
-        incl = incl.replace('.*\Z(?ms)', r'[^/]*\Z(?ms)')
-        incl = incl.replace('.*$', r'[^/]*$')
-
-    for n in archive.namelist():
-        if re.match(incl, n) and re.search(excl, n) is None:
-            yield n
+    # member names are indexed once per zip file
+    index = ArchiveIndex.for_zip(archive)
+    for n in index.query(includes, excludes, recursive):
+        yield n
 
 
 def list_files_in_zip(archive,
@@ -265,3 +485,43 @@ def list_files_in_zip(archive,
                       directories=True):
     __doc__ = yield_files_in_zip.__doc__
     return list(yield_files_in_zip(archive, includes, excludes, recursive, directories))
+
+
+def yield_files_in_archive(archive,
+                           includes=["*"],
+                           excludes=[],
+                           recursive=False):
+    """
+    List files in an archive (zip, tar, tar.gz, tar.bz2, tar.xz, tar.zst, 7z)
+
+    Same patterns semantics as `yield_files_in_zip`. Member names are read
+    once per archive (tar archives are streamed, without being extracted),
+    directories end with a ``/``.
+
+    :param archive: archive object (ZipFile, TarFile) or path
+    :type archive: [zipfile.ZipFile,tarfile.TarFile,path]
+    :param includes: pattern or list of patterns ('*.py', '*.txt', etc...)
+    :type includes: [str,list]
+    :param excludes: patterns to exclude
+    :type excludes: [str,list]
+    :param recursive: list files recursively
+    :rtype: list
+    """
+    index = ArchiveIndex.get(archive)
+    for n in index.query(includes, excludes, recursive):
+        yield n
+
+
+def list_files_in_archive(archive,
+                          includes=["*"],
+                          excludes=[],
+                          recursive=False):
+    __doc__ = yield_files_in_archive.__doc__
+    return list(yield_files_in_archive(archive, includes, excludes, recursive))
+
+
+if sys.version_info >= (3, 6):
+    # asynchronous generators are not valid syntax in older versions
+    from .aio import alist_files  # noqa
+    from .aio import ayield_entries  # noqa
+    from .aio import ayield_files  # noqa
@@ -4,19 +4,31 @@ functions/class to deal with filepaths
 """
 from __future__ import unicode_literals
 
+import collections
 import importlib
 import logging
-import operator
+import os
 import os.path
 import pathlib
+import posixpath
 import pprint
+import threading
 from builtins import object
 from builtins import str
+from concurrent.futures import ThreadPoolExecutor
 
 from future.utils import text_to_native_str
 
 from .list_files import list_files
+from .list_files import scandir
+from .list_files import yield_entries
 from .list_files import yield_files
+from .patterns import split_pattern
+from .watch import WatchedListing
+
+# suggested maximum number of resolutions kept in cache by pick_first (the
+# cache is disabled by default)
+CACHE_SIZE = 4096
 
 
 class PathList(object):
@@ -28,10 +40,36 @@ class PathList(object):
     def __init__(self, *args, **kwargs):
         """
         Appends each arg as a path of pathlist
+
+        :param watch: keep listings in memory, updated from filesystem
+                      events (True, 'inotify' or 'poll'), see `watch`
+        :param cache_size: maximum number of `pick_first` resolutions kept
+                           in cache (0, the default, disables the cache,
+                           e.g. `CACHE_SIZE`)
+        :param check_mtime: invalidate cache when the modification time of
+                            a path of pathlist changes (only files directly
+                            in those paths are detected)
+        :param lazy: defer validation of paths to their first use
+        :param workers: number of threads validating paths
         """
-        self._pathdict = {}
-        for arg in args:
-            self.add(arg)
+        self._pathdict = {}  # hits counter of each path
+        self._order = []  # paths by decreasing counter, in probing order
+        self._name_index = None  # relative path: first providing path
+        self._basenames = {}  # basename: first relative path
+        self._watcher = None
+        self._cache = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._cache_sig = None
+        self.cache_size = kwargs.pop('cache_size', 0)
+        self.check_mtime = kwargs.pop('check_mtime', False)
+        self.hits = 0
+        self.misses = 0
+        self.lazy = kwargs.pop('lazy', False)
+        self._pending = []  # paths added lazily, not validated yet
+        watch = kwargs.pop('watch', False)
+        if watch:
+            self.watch('auto' if watch is True else watch)
+        self.extend(args, workers=kwargs.pop('workers', 0))
 
     def __str__(self):
         return ("<%s>\n%s" % (self.__class__.__name__,
@@ -41,11 +79,27 @@ class PathList(object):
         '''
         Return representation of the object
         '''
-        return (
-            "<%s[%i items]>" % (self.__class__.__name__, len(self._pathdict)))
+        return ("<%s[%i items]>" % (self.__class__.__name__, len(self)))
+
+    def __len__(self):
+        self._load()
+        return len(self._pathdict)
+
+    def __contains__(self, path):
+        """
+        Return True if path is in pathlist (without resolving it if it is
+        already given as in pathlist)
+        """
+        self._load()
+        p = pathlib.Path(path)
+        if p in self._pathdict:
+            return True
+        return pathlib.Path(os.path.realpath(text_to_native_str(
+            str(path)))) in self._pathdict
 
     @property
     def pathlist(self):
+        self._load()
         return set(self._pathdict.keys())
 
     @pathlist.setter
@@ -56,8 +110,13 @@ class PathList(object):
         :type pathlist: list
         """
         self._pathdict.clear()
-        for p in pathlist:
-            self.add(p)
+        del self._order[:]
+        del self._pending[:]
+        if self._name_index is not None:
+            self._name_index = {}
+            self._basenames = {}
+        self.clear_cache()
+        self.extend(pathlist)
 
     def as_strings(self):
         """
@@ -75,19 +134,104 @@ class PathList(object):
         :type path: path
         """
         if type(path) in [list, set, tuple]:
-            return [self.exists(p) for p in path]
-        p = text_to_native_str(str(path))
-        if '*' in p:
-            # use list_files to create a list of files corresponding to pattern
-            # and add the list pathlist
-            self.add(list_files(p))
-        p = pathlib.Path(path)
-        if p not in self.pathlist:
-            if p.exists():
-                p = p.resolve()
-                self._pathdict[p] = 0  # intialize counter
-            else:
-                self._logger.warning('%s does not exist', p)
+            return self.extend(path)
+        self.extend([path])
+
+    def extend(self, paths, workers=0):
+        """
+        Append paths to pathlist (only those existing), validating them in a
+        single pass, or on first use of pathlist if it is lazy
+
+        :param paths: paths or patterns
+        :type paths: list
+        :param workers: number of threads validating paths
+        """
+        if self.lazy:
+            with self._lock:
+                self._pending.extend(paths)
+            return
+        flat = []
+        stack = list(reversed(list(paths)))
+        while stack:
+            path = stack.pop()
+            if type(path) in [list, set, tuple]:
+                stack.extend(reversed(list(path)))
+                continue
+            p = text_to_native_str(str(path))
+            if '*' in p:
+                # use list_files to create a list of files corresponding to
+                # pattern and add the list pathlist
+                stack.extend(reversed(list_files(p)))
+                continue
+            flat.append(p)
+        if workers and workers > 1 and len(flat) > 1:
+            with ThreadPoolExecutor(workers) as executor:
+                resolved = list(executor.map(_validate, flat))
+        else:
+            resolved = [_validate(p) for p in flat]
+        added = []
+        with self._lock:
+            for p, rp in zip(flat, resolved):
+                if rp is None:
+                    self._logger.warning('%s does not exist', p)
+                elif rp not in self._pathdict:
+                    self._pathdict[rp] = 0  # intialize counter
+                    self._order.append(rp)
+                    added.append(rp)
+            if added:
+                self._cache.clear()
+        if added and self._name_index is not None:
+            # indexed with the lowest priority
+            self._index_paths(added)
+
+    def _load(self):
+        """ validate paths added lazily """
+        if self._pending:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                lazy, self.lazy = self.lazy, False
+                try:
+                    self.extend(pending)
+                finally:
+                    self.lazy = lazy
+
+    def watch(self, backend='auto', **kwargs):
+        """
+        Keep listings of paths in memory, updated from filesystem events
+        (inotify) or by polling directories, so that `list_files` and
+        `pick_first` do not read unchanged directories again
+
+        :param backend: 'inotify', 'poll' or 'auto' (inotify if available)
+        :type backend: str
+        :param kwargs: other arguments of `WatchedListing`
+        :rtype: WatchedListing
+        """
+        self.unwatch()
+        self._watcher = WatchedListing(backend, **kwargs)
+        self.clear_cache()
+        return self._watcher
+
+    def unwatch(self):
+        """
+        Stop watching paths and drop listings kept in memory
+        """
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+    @property
+    def watched(self):
+        return self._watcher is not None
+
+    def _exists(self, path):
+        if self._watcher is not None:
+            return self._watcher.exists(path)
+        return path.exists()
+
+    def _is_dir(self, path):
+        if self._watcher is not None:
+            return self._watcher.is_dir(path)
+        return path.is_dir()
 
     def add_module_path(self, module, *args):
         """
@@ -111,48 +255,342 @@ class PathList(object):
             return [self.exists(p) for p in path]
         return bool(self.pick_first(path))
 
+    def clear_cache(self):
+        """
+        Clear the cache of `pick_first` resolutions
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def cache_info(self):
+        """
+        Return statistics of the cache of `pick_first` resolutions
+
+        :rtype: dict
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._cache),
+            'maxsize': self.cache_size,
+        }
+
+    def root_stats(self):
+        """
+        Return the paths of pathlist with their number of `pick_first` hits,
+        in the order they are probed
+
+        :rtype: list, items:{type: tuple}
+        """
+        self._load()
+        with self._lock:
+            return [(p, self._pathdict[p]) for p in self._order]
+
+    def _bump(self, path, i):
+        """
+        Increment the hits counter of a path found at position i in probing
+        order, and move it before paths with less hits
+        """
+        with self._lock:
+            order = self._order
+            if i >= len(order) or order[i] != path:
+                i = order.index(path)  # order changed meanwhile
+            c = self._pathdict[path] = self._pathdict[path] + 1
+            j = i
+            while j > 0 and self._pathdict[order[j - 1]] < c:
+                j -= 1
+            if j < i and self._name_index is None:
+                # (priorities of an index are kept until it is rebuilt)
+                del order[i]
+                order.insert(j, path)
+                # a path moved first may now resolve other names
+                self._cache.clear()
+
+    def _cache_signature(self):
+        # changes when resolutions in cache might be obsolete
+        sig = []
+        if self._watcher is not None:
+            self._watcher.flush()
+            sig.append(self._watcher.generation)
+        if self.check_mtime:
+            for p in self._pathdict:
+                try:
+                    sig.append(os.stat(text_to_native_str(str(p))).st_mtime)
+                except OSError:
+                    sig.append(None)
+        return sig
+
     def pick_first(self, path):
         """
         Pick the first existing match
 
+        With a ``cache_size``, resolutions are kept in a LRU cache, cleared
+        when pathlist changes. A cached path is checked to still exist
+        before being returned, but a cached miss is only invalidated when
+        directories of pathlist are watched (by any change), or with
+        ``check_mtime`` (by a change of the modification time of a path of
+        pathlist, so not by a file created in a sub directory).
+
         :param path: path or pattern
         :type path: str
         :rtype: path
         """
+        self._load()
         if type(path) in [list, set, tuple]:
             return [self.pick_first(p) for p in path]
-        path = text_to_native_str(str(path))
-        path = path.replace('\\', '/')
-        recursive = False
-        includes = []
-        if '**/' in path:
-            path, includes = path.split('**/', 1)
-            recursive = True
-        elif '*' in path:
-            bf, af = path.split('*', 1)
-            path, inc = bf.rsplit('/', 1)
-            includes = '%s*%s' % (inc, af)
-            if '**/' in includes:
-                recursive = True
-                includes = includes.split('**/')[1]
-        if os.path.exists(path):
-            return pathlib.Path(path)
-        optimized_pathlist = sorted(
-            list(self._pathdict.items()),
-            key=operator.itemgetter(1),
-            reverse=True)
-        for p, _oldc in optimized_pathlist:
-            if p.joinpath(path).exists():
-                return next(
-                    yield_files(
-                        p.joinpath(path), includes, recursive=recursive), None)
+        if not self.cache_size:
+            return self._pick_first(path)
+        key = text_to_native_str(str(path))
+        found, ret = self._cache_get(key, self._cache_signature())
+        if not found:
+            ret = self._pick_first(path)
+            self._cache_put(key, ret)
+        return ret
+
+    def pick_first_many(self, paths, workers=0):
+        """
+        Pick the first existing match of each path of a list
+
+        Relative paths are grouped by directory: each directory is listed
+        once per path of pathlist (only while some of its names are not
+        resolved), and all names are answered from those listings. Patterns
+        are resolved one by one as in `pick_first`.
+
+        :param paths: paths or patterns
+        :type paths: list
+        :param workers: number of threads listing directories concurrently
+                        (all needed directories of all paths of pathlist are
+                        then listed)
+        :rtype: list, items:{type: path}
+        """
+        self._load()
+        paths = [text_to_native_str(str(p)) for p in paths]
+        results = [None] * len(paths)
+        sig = self._cache_signature() if self.cache_size else None
+        todo = collections.OrderedDict()  # dir: {name: [positions]}
+        for i, key in enumerate(paths):
+            if self.cache_size:
+                found, ret = self._cache_get(key, sig)
+                if found:
+                    results[i] = ret
+                    continue
+            path, pattern = split_pattern(key)
+            rel = _relkey(path)
+            if (pattern is not None or self._name_index is not None
+                    or os.path.isabs(path) or not rel
+                    or rel.startswith('..')):
+                results[i] = self._pick_first(key)
+                if self.cache_size:
+                    self._cache_put(key, results[i])
+                continue
+            d, _sep, name = rel.rpartition('/')
+            todo.setdefault(d, {}).setdefault(name, []).append(i)
+        if not todo:
+            return results
+        # the current directory is probed first, as in pick_first
+        roots = [None] + list(self._order)
+        listings = {}
+        if workers and workers > 1:
+            jobs = [(r, d) for r in roots for d in todo]
+            with ThreadPoolExecutor(workers) as executor:
+                for job, names in zip(jobs,
+                                      executor.map(self._listdir, jobs)):
+                    listings[job] = names
+        for i, r in enumerate(roots):
+            for d in list(todo):
+                names = listings.get((r, d))
+                if names is None:
+                    names = self._listdir((r, d))
+                pending = todo[d]
+                for name in [n for n in pending if n in names]:
+                    for j in pending.pop(name):
+                        path = split_pattern(paths[j])[0]
+                        results[j] = (pathlib.Path(path) if r is None else
+                                      r.joinpath(path))
+                        if r is not None:
+                            self._bump(r, i - 1)
+                if not pending:
+                    del todo[d]
+            if not todo:
+                break
+        if self.cache_size:
+            for key, ret in zip(paths, results):
+                self._cache_put(key, ret)
+        return results
+
+    def _listdir(self, job):
+        # names of a sub directory of a path of pathlist (or of the current
+        # directory if path is None)
+        root, subdir = job
+        path = '.' if root is None else text_to_native_str(str(root))
+        if subdir:
+            path = os.path.join(path, subdir)
+        try:
+            lister = self._watcher.scandir if self._watcher else scandir
+            return frozenset([e.name for e in lister(path)])
+        except OSError:
+            return frozenset()
+
+    def _cache_get(self, key, sig):
+        # return (True, resolution) if key is in cache
+        with self._lock:
+            if sig != self._cache_sig:
+                self._cache.clear()
+                self._cache_sig = sig
+                ret = False
+            else:
+                ret = self._cache.get(key, False)
+        # (a resolution deleted since is resolved again)
+        if ret is not False and (ret is None or self._exists(ret)):
+            with self._lock:
+                if key in self._cache:
+                    self._cache[key] = self._cache.pop(key)
+                self.hits += 1
+            return True, ret
+        with self._lock:
+            self._cache.pop(key, None)
+            self.misses += 1
+        return False, None
+
+    def _cache_put(self, key, ret):
+        with self._lock:
+            self._cache[key] = ret
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def build_index(self, index=None):
+        """
+        Index the relative paths of all files and directories of pathlist,
+        in a single walk of its paths in probing order, so that
+        `pick_first` and `exists` resolve literal paths with a dictionary
+        lookup instead of probing each path of pathlist
+
+        Each relative path (and each basename, see `find_name`) is mapped
+        to the first path of pathlist providing it. The index is updated
+        when paths are added, changes of their content are taken into
+        account with `refresh_index`.
+
+        :param index: listing index (or its filename) used to read only
+                      directories modified since last listing
+        :type index: [ListingIndex,WatchedListing,path]
+        """
+        self._load()
+        with self._lock:
+            self._name_index = {}
+            self._basenames = {}
+            self._cache.clear()
+        self._index_paths(list(self._order), index=index)
+
+    def drop_index(self):
+        """
+        Drop the index of relative paths built by `build_index`
+        """
+        with self._lock:
+            self._name_index = None
+            self._basenames = {}
+            self._cache.clear()
+
+    def refresh_index(self, subdir='', index=None):
+        """
+        Walk again a sub directory (relative to paths of pathlist) to update
+        the index of relative paths
+
+        :param subdir: relative sub directory ('' for whole paths)
+        :type subdir: str
+        :param index: listing index (or its filename)
+        :type index: [ListingIndex,WatchedListing,path]
+        """
+        if self._name_index is None:
+            return self.build_index(index)
+        subdir = _relkey(subdir)
+        if not subdir:
+            return self.build_index(index)
+        prefix = subdir + '/'
+        with self._lock:
+            for k in [
+                    k for k in self._name_index
+                    if k == subdir or k.startswith(prefix)
+            ]:
+                del self._name_index[k]
+        self._index_paths(list(self._order), subdir, index)
+
+    def find_name(self, name):
+        """
+        Return the first file or directory with a given name at any depth of
+        pathlist, from the index built by `build_index`
+
+        :param name: basename
+        :type name: str
+        :rtype: path
+        """
+        if self._name_index is None:
+            raise ValueError('pathlist is not indexed, see build_index')
+        key = self._basenames.get(text_to_native_str(str(name)))
+        if key is not None:
+            return self._name_index[key].joinpath(key)
+
+    def _index_paths(self, paths, subdir='', index=None):
+        found = []
+        for p in paths:
+            root = os.path.join(text_to_native_str(str(p)), '')
+            src = os.path.join(root, subdir) if subdir else root
+            if not os.path.isdir(src):
+                continue
+            if subdir:
+                found.append((p, subdir))
+            for e in yield_entries(src, recursive=True, folders=1,
+                                   index=index):
+                found.append((p, e.path[len(root):].replace(os.sep, '/')))
+        with self._lock:
+            ni = self._name_index
+            if ni is None:
+                return
+            for p, key in found:
+                ni.setdefault(key, p)
+            # basenames are resolved by priority of paths, then depth
+            rank = dict([(p, i) for i, p in enumerate(self._order)])
+            best = {}
+            for key, p in ni.items():
+                name = key.rpartition('/')[2]
+                prio = (rank.get(p, len(rank)), key.count('/'), key)
+                if name not in best or prio < best[name]:
+                    best[name] = prio
+            self._basenames = dict([(n, b[2]) for n, b in best.items()])
+            self._cache.clear()
+
+    def _pick_first(self, path):
+        path, pattern = split_pattern(path)
+        if pattern is None:
+            if os.path.exists(path):
+                return pathlib.Path(path)
+            if self._name_index is not None and not os.path.isabs(path):
+                key = _relkey(path)
+                if not key.startswith('..'):
+                    p = self._name_index.get(key)
+                    return p.joinpath(path) if p is not None else None
+        elif os.path.isabs(path) and os.path.isdir(path):
+            return next(yield_files(path, pattern, index=self._watcher), None)
+        # paths with more hits are probed first
+        for i, p in enumerate(list(self._order)):
+            pp = p.joinpath(path)
+            if pattern is None:
+                if self._exists(pp):
+                    self._bump(p, i)
+                    return pp
+            elif self._is_dir(pp):
+                # patterns (and globstars) are matched in a single traversal
+                f = next(yield_files(pp, pattern, index=self._watcher), None)
+                if f is not None:
+                    self._bump(p, i)
+                    return f
 
     def yield_files(self,
                    includes=["*"],
                    excludes=[],
                    recursive=False,
                    in_parents=False,
-                   flatten=True):
+                   flatten=True,
+                   index=None):
         """
         List files in a source directory with a list of given patterns
 
@@ -163,15 +601,18 @@ class PathList(object):
         :param recursive:list files recursively
         :param in_parents: list files recursively in parents
         :param flatten: flatten return lists
+        :param index: listing index (or its filename) used to read only
+                      directories modified since last listing (defaults to
+                      watched listings)
+        :type index: [ListingIndex,WatchedListing,path]
         :rtype: array, items:{type: path}
         """
-        ret = [None] * len(self._pathdict)
-        optimized_pathlist = sorted(
-            list(self._pathdict.items()),
-            key=operator.itemgetter(1),
-            reverse=True)
-        for p, _oldc in optimized_pathlist:
-            lf = yield_files(p, includes, excludes, recursive, in_parents)
+        self._load()
+        if index is None:
+            index = self._watcher
+        for p in list(self._order):
+            lf = yield_files(p, includes, excludes, recursive, in_parents,
+                             index=index)
             if flatten:
                 for f in lf:
                     yield f
@@ -183,5 +624,19 @@ class PathList(object):
                    excludes=[],
                    recursive=False,
                    in_parents=False,
-                   flatten=True):
-        return list(self.yield_files(includes, excludes, recursive, in_parents, flatten))
+                   flatten=True,
+                   index=None):
+        return list(self.yield_files(includes, excludes, recursive, in_parents, flatten,
+                                     index))
+
+
+def _relkey(path):
+    """ normalized key of a relative path in a pathlist index """
+    key = posixpath.normpath(text_to_native_str(str(path)).replace('\\', '/'))
+    return '' if key == '.' else key
+
+
+def _validate(path):
+    """ resolved path if it exists, else None """
+    if os.path.exists(path):
+        return pathlib.Path(os.path.realpath(path))
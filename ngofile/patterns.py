@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+compiled include/exclude patterns used to filter file listings
+
+author: Cedric ROMAN (roman@numengo.com)
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import fnmatch
+import os.path
+import re
+from builtins import object
+from builtins import str
+
+from future.utils import text_to_native_str
+
+# maximum number of pattern sets kept in cache
+CACHE_SIZE = 1024
+
+_magic_check = re.compile('[*?[]')
+
+
+def _as_patterns(patterns):
+    """ normalize a pattern or a list of patterns to a frozenset of native strings """
+    if patterns is None:
+        return frozenset()
+    if not isinstance(patterns, (list, set, frozenset, tuple)):
+        patterns = [patterns]
+    return frozenset([text_to_native_str(str(p)) for p in patterns])
+
+
+def _segments(pattern):
+    """ split a path pattern in segments, ignoring empty and current dir ones """
+    return [s for s in pattern.replace('\\', '/').split('/') if s not in ('', '.')]
+
+
+class _Node(object):
+    """
+    Node of a trie of path patterns segments
+
+    Literal segments are looked up in a dictionary, wildcard segments are
+    matched with their compiled regex, a ``**`` segment is a node looping on
+    any segment.
+    """
+    __slots__ = ('literals', 'wildcards', 'star', 'loop', 'terminal', 'fold')
+
+    def __init__(self, loop=False, fold=True):
+        self.fold = fold  # literal segments are lower case
+        self.literals = {}
+        self.wildcards = []
+        self.star = None
+        self.loop = loop
+        self.terminal = False
+
+    def add(self, segments):
+        node = self
+        for seg in segments:
+            if seg == '**':
+                if node.star is None:
+                    node.star = _Node(loop=True, fold=self.fold)
+                node = node.star
+            elif _magic_check.search(seg):
+                rx = fnmatch.translate(seg)
+                for wrx, child in node.wildcards:
+                    if wrx.pattern == rx:
+                        node = child
+                        break
+                else:
+                    child = _Node(fold=self.fold)
+                    node.wildcards.append(
+                        (re.compile(rx, re.IGNORECASE if self.fold else 0),
+                         child))
+                    node = child
+            else:
+                node = node.literals.setdefault(
+                    seg.lower() if self.fold else seg, _Node(fold=self.fold))
+        node.terminal = True
+
+
+def _closure(nodes):
+    """ add nodes reachable without consuming any segment (through ``**``) """
+    out = set()
+    stack = list(nodes)
+    while stack:
+        n = stack.pop()
+        if n not in out:
+            out.add(n)
+            if n.star is not None:
+                stack.append(n.star)
+    return frozenset(out)
+
+
+def _step(nodes, name):
+    """ return the nodes reached from nodes by consuming segment name """
+    if not nodes:
+        return nodes
+    key = name.lower()
+    nxt = []
+    for n in nodes:
+        if n.loop:
+            nxt.append(n)
+        child = n.literals.get(key if n.fold else name)
+        if child is not None:
+            nxt.append(child)
+        for rx, child in n.wildcards:
+            if rx.match(name):
+                nxt.append(child)
+    return _closure(nxt)
+
+
+def split_pattern(path):
+    """
+    Split a path pattern in its literal base directory and the remaining
+    pattern (None if path contains no wildcard)
+
+    >>> split_pattern('src/**/test_*.py')
+    ('src', '**/test_*.py')
+
+    :param path: path or pattern
+    :type path: str
+    :rtype: tuple
+    """
+    path = text_to_native_str(str(path)).replace('\\', '/')
+    if not _magic_check.search(path):
+        return path, None
+    parts = path.split('/')
+    for i, seg in enumerate(parts):
+        if _magic_check.search(seg):
+            base = '/'.join(parts[:i])
+            if not base and i:
+                base = '/'  # absolute pattern at filesystem root
+            return base, '/'.join(parts[i:])
+
+
+class _PatternState(object):
+    """
+    State of a pattern set in a sub directory of the listing root, holding
+    the nodes of exclude and include path patterns still matching
+    """
+    __slots__ = ('patterns', 'excl', 'incl')
+
+    def __init__(self, patterns, excl, incl):
+        self.patterns = patterns
+        self.excl = excl
+        self.incl = incl
+
+    def __repr__(self):
+        return '<%s of %r>' % (self.__class__.__name__, self.patterns)
+
+    def include(self, name):
+        return self.patterns._include(self.incl, name)
+
+    def exclude(self, name, path=None):
+        return self.patterns._exclude(self.excl, name, path)
+
+    def descend(self, name, recursive=True):
+        return self.patterns._descend(self.excl, self.incl, name, recursive)
+
+
+class PatternSet(object):
+    """
+    Compiled and immutable set of include/exclude patterns
+
+    Patterns without a ``/`` are matched (case insensitive, unless compiled
+    with ``case_sensitive``) against entry names, at any depth. Patterns
+    containing a ``/`` are path patterns, relative to the listing root
+    (``build/tmp``, ``src/*/tests``), which can use ``**`` to match any
+    number of directories (``src/**/node_modules``).
+    Absolute excludes are matched against the full path of entries.
+
+    Path patterns are compiled in a trie of segments (literal segments are
+    looked up in a dictionary, wildcard ones matched by their compiled
+    regex), so that a whole set of patterns is evaluated in a single
+    traversal: excluded directories are pruned without being read, and
+    directories in which no include pattern can match are skipped. Include
+    path patterns select their directories even in a non recursive listing.
+    In a recursive listing, the last segment of an include path pattern
+    also matches below its directory: ``aa/*.data`` selects ``*.data``
+    files anywhere below ``aa``, as ``aa/**/*.data``.
+
+    Instances are built with `PatternSet.compile` which caches them by
+    patterns, so that regular expressions are compiled only once per set of
+    patterns. As they hold no state, they can be shared between concurrent
+    listings. A pattern set is the state of patterns at the listing root,
+    `descend` returns their state in a sub directory.
+    """
+    __slots__ = ('includes', 'excludes', 'case_sensitive', '_inclp',
+                 '_floating_includes',
+                 '_exclp', '_absp', '_excl_root', '_incl_root', '_incl_rec',
+                 '_nopath')
+    _cache = {}
+
+    def __init__(self, includes, excludes, case_sensitive=False):
+        set_ = super(PatternSet, self).__setattr__
+        set_('includes', includes)
+        set_('excludes', excludes)
+        set_('case_sensitive', case_sensitive)
+        flags = 0 if case_sensitive else re.IGNORECASE
+        names, paths = [], []
+        for i in includes:
+            segs = _segments(i)
+            if len(segs) > 1:
+                paths.append(segs)
+            elif segs:
+                names.append(segs[0])
+        if includes and not names:
+            incl = r'$.'  # only path patterns
+        else:
+            incl = r'|'.join([fnmatch.translate(x) for x in names])
+        set_('_inclp', re.compile(incl, flags))
+        set_('_floating_includes', bool(names) or not includes)
+        set_('_incl_root', self._trie(paths, case_sensitive))
+        # in a recursive listing, last segments match at any depth
+        set_('_incl_rec', self._trie([
+            segs if segs[-2] == '**' else segs[:-1] + ['**', segs[-1]]
+            for segs in paths
+        ], case_sensitive))
+        names, paths, abspaths = [], [], []
+        for e in excludes:
+            segs = _segments(e)
+            if os.path.isabs(e):
+                abspaths.append(e.replace('\\', '/').rstrip('/'))
+            elif len(segs) == 1 or (len(segs) == 2 and segs[0] == '**'
+                                    and segs[1] != '**'):
+                # matches a name at any depth
+                names.append(segs[-1])
+            elif segs:
+                paths.append(segs)
+        excl = r'|'.join([fnmatch.translate(x) for x in names]) or r'$.'
+        set_('_exclp', re.compile(excl, flags))
+        absp = r'|'.join([fnmatch.translate(x) for x in abspaths])
+        set_('_absp', re.compile(absp, flags) if absp else None)
+        set_('_excl_root', self._trie(paths, case_sensitive))
+        set_('_nopath', not self._incl_root and not self._excl_root)
+
+    @staticmethod
+    def _trie(paths, case_sensitive=False):
+        if not paths:
+            return frozenset()
+        root = _Node(fold=not case_sensitive)
+        for segs in paths:
+            root.add(segs)
+        return _closure([root])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def __repr__(self):
+        return '<%s includes=%r excludes=%r>' % (
+            self.__class__.__name__, sorted(self.includes),
+            sorted(self.excludes))
+
+    @classmethod
+    def compile(cls, includes=["*"], excludes=[], case_sensitive=False):
+        """
+        Return the compiled pattern set corresponding to patterns
+
+        :param includes: pattern or list of patterns (*.py, *.txt, etc...)
+        :type includes: [str,list]
+        :param excludes: pattern or patterns to exclude
+        :type excludes: [str,list]
+        :param case_sensitive: match patterns case sensitively (listings
+                               match case insensitively, copies case
+                               sensitively)
+        :type case_sensitive: bool
+        :rtype: PatternSet
+        """
+        if isinstance(includes, cls):
+            return includes
+        key = (_as_patterns(includes), _as_patterns(excludes),
+               bool(case_sensitive))
+        ps = cls._cache.get(key)
+        if ps is None:
+            if len(cls._cache) >= CACHE_SIZE:
+                cls._cache.clear()
+            # concurrent compilations of the same patterns are harmless,
+            # only one of them is kept
+            ps = cls._cache.setdefault(key, cls(*key))
+        return ps
+
+    def include(self, name):
+        """ return True if an entry of the listing root matches an include pattern """
+        return self._include(self._incl_root, name)
+
+    def exclude(self, name, path=None):
+        """
+        return True if an entry of the listing root matches an exclude
+        pattern
+
+        :param name: entry name
+        :param path: entry path, to match absolute excludes
+        """
+        return self._exclude(self._excl_root, name, path)
+
+    def descend(self, name, recursive=True):
+        """
+        Return the state of patterns in a sub directory of the listing root,
+        or None if no file can be selected in it
+
+        :param name: sub directory name
+        :param recursive: listing is recursive
+        :rtype: PatternSet
+        """
+        return self._descend(self._excl_root,
+                             self._incl_rec if recursive else self._incl_root,
+                             name, recursive)
+
+    def match(self, relpath):
+        """
+        Return True if a path relative to the listing root is selected by
+        patterns (included and not excluded, nor any of its parents)
+
+        :param relpath: relative path
+        :type relpath: str
+        :rtype: bool
+        """
+        segs = _segments(text_to_native_str(str(relpath)))
+        if not segs:
+            return False
+        state = self
+        for seg in segs[:-1]:
+            if state.exclude(seg):
+                return False
+            state = state.descend(seg)
+            if state is None:
+                return False
+        return not state.exclude(segs[-1]) and state.include(segs[-1])
+
+    def _include(self, nodes, name):
+        if self._inclp.match(name):
+            return True
+        for n in _step(nodes, name):
+            if n.terminal:
+                return True
+        return False
+
+    def _exclude(self, nodes, name, path):
+        if self._exclp.match(name):
+            return True
+        if path is not None and self._absp is not None and self._absp.match(
+                path.replace('\\', '/')):
+            return True
+        for n in _step(nodes, name):
+            if n.terminal:
+                return True
+        return False
+
+    def _descend(self, excl, incl, name, recursive):
+        if self._nopath:
+            # no path pattern, state is the same in all directories
+            return self if recursive else None
+        incl = _step(incl, name)
+        if not incl and not (recursive and self._floating_includes):
+            # no include pattern can match below
+            return None
+        return _PatternState(self, _step(excl, name), incl)
+
+    def with_excludes(self, excludes):
+        """
+        Return the pattern set with additional excludes
+
+        :param excludes: pattern or patterns to exclude
+        :type excludes: [str,list]
+        :rtype: PatternSet
+        """
+        return self.compile(self.includes,
+                            self.excludes.union(_as_patterns(excludes)),
+                            self.case_sensitive)
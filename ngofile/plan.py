@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+copy plans, listing the operations of a copy before running them
+
+author: Cedric ROMAN (roman@numengo.com)
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import io
+import json
+from builtins import object
+from builtins import str
+
+from future.utils import text_to_native_str
+
+
+class CopyPlan(object):
+    """
+    Serializable plan of a copy
+
+    A plan lists the destination directories to make, the files to create,
+    update or skip (each source file with its destinations by action) and
+    the directories whose stats are copied once their content is copied
+    (in post order), and in mirror mode the extraneous destination files
+    and directories to delete.
+
+    Plans are built by `ngofile.copy.plan_copy` (or ``advanced_copy`` with
+    ``dry_run=True``) and run by ``advanced_copy(plan=plan)``. They can be
+    saved as JSON to be reviewed, and split in shards to be run in parallel
+    or on several machines.
+    """
+    ACTIONS = ('create', 'update', 'skip')
+
+    def __init__(self, src=None, dsts=None, dirs=None, files=None,
+                 dirstats=None, sync='content', deletes=None):
+        """
+        :param src: source file or directory
+        :param dsts: destination files or directories
+        :type dsts: list
+        :param dirs: destination directories to make, parents first
+        :type dirs: list
+        :param files: files, as dictionaries with ``src``, ``size`` and the
+                      list of destinations of each action
+        :type files: list
+        :param dirstats: (source directory, destination directories) whose
+                         stats are copied after their content
+        :type dirstats: list
+        :param sync: sync strategy used to build the plan
+        :param deletes: (path, is_dir) of destination files and directories
+                        to delete, directories after their content
+        :type deletes: list
+        """
+        self.src = text_to_native_str(str(src)) if src is not None else None
+        self.dsts = [text_to_native_str(str(d)) for d in dsts or []]
+        self.dirs = list(dirs or [])
+        self.files = list(files or [])
+        self.dirstats = [(s, list(d)) for s, d in dirstats or []]
+        self.sync = sync
+        self.deletes = [(p, bool(d)) for p, d in deletes or []]
+
+    def __repr__(self):
+        counts = self.counts()
+        return '<%s %s create:%i update:%i skip:%i delete:%i (%i bytes)>' % (
+            self.__class__.__name__, self.src, counts['create'],
+            counts['update'], counts['skip'], counts['delete'],
+            self.bytes_to_copy)
+
+    def __eq__(self, other):
+        return (isinstance(other, CopyPlan)
+                and self.to_dict() == other.to_dict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def add_file(self, src, size, create=(), update=(), skip=()):
+        """
+        Add a source file with its destinations by action
+
+        :param src: source file
+        :param size: size of source file
+        :param create: destinations to create
+        :param update: destinations to update
+        :param skip: destinations up to date
+        """
+        self.files.append({
+            'src': src,
+            'size': size,
+            'create': list(create),
+            'update': list(update),
+            'skip': list(skip),
+        })
+
+    def counts(self):
+        """
+        Return the number of files by action, of directories to make and of
+        files or directories to delete
+
+        :rtype: dict
+        """
+        counts = dict([(a, 0) for a in self.ACTIONS])
+        for f in self.files:
+            for a in self.ACTIONS:
+                counts[a] += len(f[a])
+        counts['dirs'] = len(self.dirs)
+        counts['delete'] = len(self.deletes)
+        return counts
+
+    @property
+    def bytes_to_copy(self):
+        """ total number of bytes written by plan """
+        return sum([f['size'] * (len(f['create']) + len(f['update']))
+                    for f in self.files])
+
+    @property
+    def bytes_skipped(self):
+        """ total number of bytes of files up to date """
+        return sum([f['size'] * len(f['skip']) for f in self.files])
+
+    def to_copy(self):
+        """
+        Return the files to copy with their destinations
+
+        :rtype: list, items:{type: tuple}
+        """
+        return [(f['src'], f['create'] + f['update']) for f in self.files
+                if f['create'] or f['update']]
+
+    def shard(self, n):
+        """
+        Split files to copy in n plans of balanced sizes
+
+        Shards can be run in any order or concurrently: all of them make
+        destination directories, none of them deletes files or copies
+        directory stats (see `finalizer`).
+
+        :param n: number of shards
+        :type n: int
+        :rtype: list, items:{type: CopyPlan}
+        """
+        shards = [
+            CopyPlan(self.src, self.dsts, self.dirs, sync=self.sync)
+            for _i in range(max(n, 1))
+        ]
+        loads = [0] * len(shards)
+        files = sorted([f for f in self.files if f['create'] or f['update']],
+                       key=lambda f: -f['size'])
+        for f in files:
+            i = loads.index(min(loads))
+            shards[i].files.append(f)
+            loads[i] += f['size'] * (len(f['create']) + len(f['update']))
+        return shards
+
+    def finalizer(self):
+        """
+        Return the plan deleting files and copying directory stats only, to
+        run once all shards are done
+
+        :rtype: CopyPlan
+        """
+        return CopyPlan(self.src, self.dsts, self.dirs, None, self.dirstats,
+                        self.sync, self.deletes)
+
+    def to_dict(self):
+        """
+        Return plan as a dictionary of JSON types
+
+        :rtype: dict
+        """
+        return {
+            'src': self.src,
+            'dsts': self.dsts,
+            'sync': self.sync,
+            'dirs': self.dirs,
+            'files': self.files,
+            'dirstats': [[s, d] for s, d in self.dirstats],
+            'deletes': [[p, d] for p, d in self.deletes],
+            'bytes_to_copy': self.bytes_to_copy,
+            'counts': self.counts(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build a plan from a dictionary returned by `to_dict`
+
+        :param data: plan dictionary
+        :type data: dict
+        :rtype: CopyPlan
+        """
+        return cls(data['src'], data['dsts'], data['dirs'], data['files'],
+                   data['dirstats'], data.get('sync', 'content'),
+                   data.get('deletes'))
+
+    def save(self, filename):
+        """
+        Save plan in a JSON file
+
+        :param filename: filename of plan
+        :type filename: path
+        """
+        with io.open(text_to_native_str(str(filename)), 'w',
+                     encoding='utf-8') as f:
+            f.write(str(json.dumps(self.to_dict(), indent=1)))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a plan saved in a JSON file
+
+        :param filename: filename of plan
+        :type filename: path
+        :rtype: CopyPlan
+        """
+        with io.open(text_to_native_str(str(filename)), 'r',
+                     encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
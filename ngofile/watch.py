@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+in-memory directory listings kept up to date by watching the filesystem
+
+author: Cedric ROMAN (roman@numengo.com)
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import errno
+import logging
+import os
+import os.path
+import threading
+import time
+from builtins import object
+from builtins import str
+
+from future.utils import text_to_native_str
+
+from .index import RACY_DELAY
+from .index import IndexEntry
+
+try:
+    from os import scandir
+except ImportError:  # python < 3.5
+    from scandir import scandir
+
+try:
+    import inotify_simple
+except ImportError:  # optional, polling is used without it
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+# default interval (in seconds) between two polls of watched directories
+POLL_INTERVAL = 1.
+
+if inotify_simple is not None:
+    _flags = inotify_simple.flags
+    _MASK = (_flags.CREATE | _flags.DELETE | _flags.MOVED_FROM
+             | _flags.MOVED_TO | _flags.DELETE_SELF | _flags.MOVE_SELF
+             | _flags.ONLYDIR)
+
+
+class WatchedListing(object):
+    """
+    In-memory listings of directories, updated from filesystem events
+
+    A directory is read from disk the first time it is listed, its entries
+    are then kept in memory and updated from inotify events (with the
+    ``inotify_simple`` package on Linux) or by a thread polling the
+    modification time of listed directories. Listings of unchanged
+    directories are answered from memory without any system call.
+
+    It has the interface of a `ListingIndex`, and can be given as ``index``
+    to the listing functions. Directories are keyed by their path, so it can
+    be shared by several roots.
+    """
+
+    def __init__(self, backend='auto', interval=POLL_INTERVAL):
+        """
+        Start watching
+
+        :param backend: 'inotify', 'poll' or 'auto' (inotify if available)
+        :type backend: str
+        :param interval: interval in seconds between two polls
+        :type interval: float
+        """
+        if backend == 'auto':
+            backend = 'inotify' if inotify_simple is not None else 'poll'
+        if backend not in ('inotify', 'poll'):
+            raise ValueError('unknown watch backend %r' % backend)
+        if backend == 'inotify' and inotify_simple is None:
+            raise ValueError('inotify_simple is required to watch with inotify')
+        self.backend = backend
+        self.interval = interval
+        self._lock = threading.RLock()
+        self._dirs = {}  # path: (mtime, {name: is_dir})
+        self._wds = {}  # watch descriptor: path
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # incremented each time a listing changes
+        self._inotify = None
+        self._stop = threading.Event()
+        self._poller = None
+        if backend == 'inotify':
+            self._inotify = inotify_simple.INotify()
+        else:
+            self._poller = threading.Thread(target=self._poll_loop)
+            self._poller.daemon = True
+            self._poller.start()
+
+    def __repr__(self):
+        return '<%s[%i dirs] %s>' % (self.__class__.__name__,
+                                     len(self._dirs), self.backend)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Stop watching and clear listings
+        """
+        self._stop.set()
+        with self._lock:
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+            self._dirs.clear()
+            self._wds.clear()
+
+    def flush(self):
+        """
+        Apply pending filesystem events to listings
+        """
+        if self._inotify is None:
+            return
+        with self._lock:
+            for ev in self._inotify.read(timeout=0):
+                self._on_event(ev)
+                self.generation += 1
+
+    def scandir(self, path):
+        """
+        List a directory, from memory if it is already watched
+
+        :param path: directory to list
+        :type path: str
+        :rtype: list, items:{type: IndexEntry}
+        """
+        path = text_to_native_str(str(path))
+        names = self._names(path)
+        with self._lock:
+            items = list(names.items())
+        return [IndexEntry(os.path.join(path, n), d) for n, d in items]
+
+    def exists(self, path):
+        """
+        Return True if path exists, looking it up in its parent listing
+
+        :param path: path to check
+        :type path: path
+        :rtype: bool
+        """
+        return self._lookup(path) is not None
+
+    def is_dir(self, path):
+        """
+        Return True if path is an existing directory
+
+        :param path: path to check
+        :type path: path
+        :rtype: bool
+        """
+        return bool(self._lookup(path))
+
+    def _lookup(self, path):
+        # type of an entry (True for a directory) from its parent listing, or
+        # None if it does not exist
+        path = os.path.normpath(text_to_native_str(str(path)))
+        parent, name = os.path.split(path)
+        if not name:  # filesystem root
+            return os.path.isdir(path) or None
+        self.flush()
+        if parent not in self._dirs and self._listed_above(parent):
+            # a missing parent is answered from the listings above it
+            if not self._lookup(parent):
+                return None
+        try:
+            return self._names(parent).get(name)
+        except OSError as er:
+            if er.errno == errno.ENOENT:
+                # list the directory where path stops existing, to answer
+                # next lookups from memory
+                self._lookup(parent)
+            return None
+
+    def _listed_above(self, path):
+        # True if the listing of an ancestor of path is in memory
+        with self._lock:
+            while True:
+                up = os.path.dirname(path)
+                if up == path:
+                    return False
+                path = up
+                if path in self._dirs:
+                    return True
+
+    def _names(self, path):
+        self.flush()
+        with self._lock:
+            cached = self._dirs.get(path)
+            if cached is not None:
+                self.hits += 1
+                return cached[1]
+        self.misses += 1
+        watched = self._inotify is None
+        if not watched:
+            # watch is added before reading, so that no change is missed
+            try:
+                with self._lock:
+                    self._wds[self._inotify.add_watch(path, _MASK)] = path
+                watched = True
+            except OSError as er:
+                if er.errno == errno.ENOENT:
+                    raise
+                logger.warning('impossible to watch %s: %s', path, er)
+        mtime = os.stat(path).st_mtime
+        names = dict([(e.name, e.is_dir()) for e in scandir(path)])
+        if watched:  # otherwise it is read again each time
+            with self._lock:
+                self._dirs[path] = (mtime, names)
+        return names
+
+    def _drop(self, path):
+        """ drop listing of a directory and its sub directories """
+        self._dirs.pop(path, None)
+        prefix = os.path.join(path, '')
+        for p in [p for p in self._dirs if p.startswith(prefix)]:
+            del self._dirs[p]
+
+    def _on_event(self, ev):
+        flags = inotify_simple.flags
+        if ev.mask & flags.Q_OVERFLOW:
+            logger.warning('inotify queue overflow, listings are dropped')
+            self._dirs.clear()
+            return
+        path = self._wds.get(ev.wd)
+        if path is None:
+            return
+        if ev.mask & flags.IGNORED:
+            del self._wds[ev.wd]
+            self._drop(path)
+            return
+        if ev.mask & (flags.DELETE_SELF | flags.MOVE_SELF):
+            self._drop(path)
+            if ev.mask & flags.MOVE_SELF:
+                # watch would follow the directory to its new path
+                del self._wds[ev.wd]
+                try:
+                    self._inotify.rm_watch(ev.wd)
+                except OSError:
+                    pass
+            return
+        cached = self._dirs.get(path)
+        if cached is None:
+            return
+        names = cached[1]
+        if ev.mask & (flags.CREATE | flags.MOVED_TO):
+            is_dir = bool(ev.mask & flags.ISDIR)
+            if not is_dir and os.path.isdir(os.path.join(path, ev.name)):
+                is_dir = True  # symbolic link to a directory
+            names[ev.name] = is_dir
+        elif ev.mask & (flags.DELETE | flags.MOVED_FROM):
+            names.pop(ev.name, None)
+            self._drop(os.path.join(path, ev.name))
+
+    def _poll_loop(self):
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        """
+        Drop listings of directories modified since they were read, so that
+        they are read again when listed
+        """
+        with self._lock:
+            dirs = list(self._dirs.items())
+        now = time.time()
+        for path, (mtime, _names) in dirs:
+            try:
+                mtime2 = os.stat(path).st_mtime
+            except OSError:
+                mtime2 = None
+            if mtime2 != mtime or now - mtime < RACY_DELAY:
+                with self._lock:
+                    if self._dirs.get(path, (None, ))[0] == mtime:
+                        del self._dirs[path]
+                        self.generation += 1
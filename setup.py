@@ -79,6 +79,8 @@ install_requires=[
     'click',
     'pathlib',
     'boto',
+    'scandir; python_version < "3.5"',
+    'futures; python_version < "3"',
 ]
 
 test_requires=[
@@ -87,6 +89,9 @@ test_requires=[
 ]
 
 extras_requires={
+    'zstd': ['zstandard'],
+    '7z': ['py7zr'],
+    'watch': ['inotify_simple; sys_platform == "linux"'],
 }
 
 setup(
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 6):
+    # asynchronous generators are a syntax error before python 3.6
+    collect_ignore.append('test_aio.py')
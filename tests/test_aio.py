@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for the asyncio API
+
+author: Cedric ROMAN
+email: roman@numengo.com
+licence: GNU GPLv3
+"""
+import asyncio
+import os
+from pathlib import Path
+
+from ngofile.list_files import alist_files
+from ngofile.list_files import ayield_files
+from ngofile.list_files import list_files
+
+test_dir_a = Path(__file__).resolve().parent.joinpath('a')
+
+
+def test_alist_files():
+    fs = list_files(test_dir_a, "*.data", ["bb"], recursive=True, folders=1)
+
+    async def first():
+        agen = ayield_files(test_dir_a, recursive=True)
+        try:
+            return await agen.__anext__()
+        finally:
+            await agen.aclose()
+
+    loop = asyncio.new_event_loop()
+    try:
+        fs1 = loop.run_until_complete(
+            alist_files(test_dir_a, "*.data", ["bb"], recursive=True,
+                        folders=1))
+        assert sorted(fs1) == sorted(fs)
+        fs2 = loop.run_until_complete(
+            alist_files(test_dir_a, "*.data", ["bb"], recursive=True,
+                        folders=1, ordered=True))
+        assert fs2 == fs
+        assert loop.run_until_complete(first()) is not None
+    finally:
+        loop.close()
+
+
+def test_alist_files_bounded(tmp_path, caplog):
+    for i in range(60):
+        tmp_path.joinpath('d%i' % i).mkdir()
+        tmp_path.joinpath('d%i' % i, 'f.txt').write_text('f')
+    tmp_path.joinpath('f.txt').write_text('f')
+
+    class Lister(object):
+        read = []
+
+        def scandir(self, path):
+            self.read.append(path)
+            return list(os.scandir(path))
+
+    async def first(ordered):
+        agen = ayield_files(tmp_path, recursive=True, workers=1,
+                            ordered=ordered, index=Lister())
+        try:
+            await agen.__anext__()
+            await agen.__anext__()
+            await asyncio.sleep(0.2)
+        finally:
+            await agen.aclose()
+
+    loop = asyncio.new_event_loop()
+    try:
+        for ordered in (False, True):
+            del Lister.read[:]
+            loop.run_until_complete(first(ordered))
+            # a slow consumer does not buffer the whole tree
+            assert len(Lister.read) <= 6
+        loop.run_until_complete(asyncio.sleep(0))
+    finally:
+        loop.close()
+    # cancelled reads are not reported as errors
+    assert not [r for r in caplog.records if r.name == 'asyncio']
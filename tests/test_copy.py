@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for copy
+
+author: Cedric ROMAN
+email: roman@numengo.com
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import os
+
+from ngofile.copy import advanced_copy
+from ngofile.digests import DigestCache
+
+
+def _tree(root):
+    root.joinpath('sub').mkdir(parents=True)
+    root.joinpath('a.txt').write_text('aaaa')
+    root.joinpath('sub', 'b.txt').write_text('bbbb')
+    root.joinpath('sub', 'c.log').write_text('cccc')
+    # sources are old enough for their digests to be cached
+    for f in ('a.txt', 'sub/b.txt', 'sub/c.log', 'sub', '.'):
+        os.utime(str(root.joinpath(f)), (1e9, 1e9))
+
+
+def test_advanced_copy(tmp_path):
+    src = tmp_path.joinpath('src')
+    dst = tmp_path.joinpath('dst')
+    _tree(src)
+    advanced_copy(src, dst, excludes=['*.log'])
+    assert dst.joinpath('sub', 'b.txt').read_text() == 'bbbb'
+    assert not dst.joinpath('sub', 'c.log').exists()
+    # copystat is applied on directories after their content
+    assert dst.joinpath('sub').stat().st_mtime == 1e9
+
+
+def test_sync_strategies(tmp_path):
+    src = tmp_path.joinpath('src')
+    dst = tmp_path.joinpath('dst')
+    _tree(src)
+    db = tmp_path.joinpath('digests.db')
+    advanced_copy(src, dst, sync='checksum', digest_cache=db)
+
+    # same size and mtime, but different content
+    src.joinpath('a.txt').write_text('AAAA')
+    os.utime(str(src.joinpath('a.txt')), (1e9, 1e9))
+    advanced_copy(src, dst, sync='mtime+size')
+    assert dst.joinpath('a.txt').read_text() == 'aaaa'
+    with DigestCache(db) as digests:
+        advanced_copy(src, dst, sync='checksum', digest_cache=digests)
+        # only the modified source is read, other digests are cached
+        assert digests.misses == 1
+    assert dst.joinpath('a.txt').read_text() == 'AAAA'
+
+    dst.joinpath('sub', 'b.txt').write_text('BBBB')
+    advanced_copy(src, dst, sync='always')
+    assert dst.joinpath('sub', 'b.txt').read_text() == 'bbbb'
+
+
+def test_parallel_copy(tmp_path):
+    import pytest
+    from ngofile.exceptions import CopyException
+
+    src = tmp_path.joinpath('src')
+    dst = tmp_path.joinpath('dst')
+    for i in range(5):
+        d = src.joinpath('d%i' % i, 'sub')
+        d.mkdir(parents=True)
+        for j in range(10):
+            d.joinpath('f%i.txt' % j).write_text('%i%i' % (i, j))
+        os.utime(str(d), (1e9, 1e9))
+    # dangling link cannot be copied
+    os.symlink(str(src.joinpath('missing')), str(src.joinpath('d0', 'bad')))
+    with pytest.raises(CopyException) as exc:
+        advanced_copy(src, dst, workers=4)
+    errors = exc.value.args[0]
+    assert len(errors) == 1 and errors[0][0].endswith('bad')
+    assert len(list(dst.glob('*/sub/*.txt'))) == 50
+    assert dst.joinpath('d3', 'sub', 'f7.txt').read_text() == '37'
+    assert dst.joinpath('d3', 'sub').stat().st_mtime == 1e9
+
+
+def test_copyfile_backends(tmp_path):
+    import pytest
+    from ngofile.copyfile import copyfile
+
+    src = tmp_path.joinpath('src.bin')
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    src.write_bytes(data)
+    for backend in ('copy_file_range', 'sendfile', 'buffered'):
+        dst = tmp_path.joinpath(backend)
+        used = copyfile(src, dst, [backend, 'buffered'], 1024 * 1024)
+        assert used in (backend, 'buffered')
+        assert dst.read_bytes() == data
+    # reflink is only possible on copy-on-write file systems
+    assert copyfile(src, tmp_path.joinpath('any')) in (
+        'reflink', 'copy_file_range', 'sendfile', 'buffered')
+    with pytest.raises(ValueError):
+        copyfile(src, tmp_path.joinpath('x'), ['unknown'])
+    stats = advanced_copy(src, tmp_path.joinpath('d'), backends=['buffered'])
+    assert stats['buffered'] == 1
+    stats = advanced_copy(src, tmp_path.joinpath('d'))
+    assert stats['uptodate'] == 1
+
+
+def test_fanout_copy(tmp_path):
+    src = tmp_path.joinpath('src')
+    _tree(src)
+    dsts = [tmp_path.joinpath('m%i' % i) for i in range(3)]
+    stats = advanced_copy(src, dsts, fanout=True)
+    assert stats['fanout'] == 3
+    for d in dsts:
+        assert d.joinpath('sub', 'b.txt').read_text() == 'bbbb'
+        assert d.joinpath('sub').stat().st_mtime == 1e9
+    # only the destination which is not up to date is written
+    dsts[1].joinpath('a.txt').write_text('old')
+    stats = advanced_copy(src, dsts, sync='mtime+size', fanout=True,
+                          workers=2)
+    assert stats['uptodate'] == 2 and stats['fanout'] == 0
+    assert dsts[1].joinpath('a.txt').read_text() == 'aaaa'
+    dsts[0].joinpath('a.txt').unlink()
+    dsts[2].joinpath('a.txt').unlink()
+    stats = advanced_copy(src.joinpath('a.txt'), dsts, fanout=True)
+    assert stats['fanout'] == 1
+    assert dsts[2].joinpath('a.txt').read_text() == 'aaaa'
+
+
+def test_copy_plan(tmp_path):
+    from ngofile.plan import CopyPlan
+
+    src = tmp_path.joinpath('src')
+    dst = tmp_path.joinpath('dst')
+    _tree(src)
+    plan = advanced_copy(src, dst, excludes=['*.log'], dry_run=True)
+    assert not dst.exists()
+    counts = plan.counts()
+    assert counts['create'] == 2 and counts['dirs'] == 2
+    assert plan.bytes_to_copy == 8
+    fn = tmp_path.joinpath('plan.json')
+    plan.save(fn)
+    assert CopyPlan.load(fn) == plan
+    stats = advanced_copy(plan=CopyPlan.load(fn), workers=2)
+    assert stats['buffered'] + stats['reflink'] + stats['copy_file_range'] \
+        + stats['sendfile'] == 2
+    assert dst.joinpath('sub', 'b.txt').read_text() == 'bbbb'
+    assert dst.joinpath('sub').stat().st_mtime == 1e9
+
+    src.joinpath('a.txt').write_text('AAAAAA')
+    plan = advanced_copy(src, dst, dry_run=True)
+    counts = plan.counts()
+    assert (counts['create'], counts['update'], counts['skip']) == (1, 1, 1)
+    assert plan.bytes_to_copy == 10 and plan.bytes_skipped == 4
+    shards = plan.shard(2)
+    assert sorted([s.bytes_to_copy for s in shards]) == [4, 6]
+    for s in shards:
+        advanced_copy(plan=s)
+    advanced_copy(plan=plan.finalizer())
+    assert dst.joinpath('a.txt').read_text() == 'AAAAAA'
+    assert dst.joinpath('sub', 'c.log').read_text() == 'cccc'
+    assert advanced_copy(plan=plan, shards=2)['uptodate'] == 1
+
+
+def test_journaled_copy(tmp_path):
+    from ngofile.copyfile import copyfile
+    from ngofile.journal import CopyJournal
+
+    src = tmp_path.joinpath('src')
+    dst = tmp_path.joinpath('dst')
+    _tree(src)
+    big = src.joinpath('big.bin')
+    data = os.urandom(3 * 1024 * 1024)
+    big.write_bytes(data)
+    offsets = []
+    copyfile(big, tmp_path.joinpath('big.bin'), ['buffered'], 1024 * 1024,
+             progress=offsets.append, progress_every=1)
+    assert offsets == [1024 * 1024, 2 * 1024 * 1024, 3 * 1024 * 1024]
+
+    fn = tmp_path.joinpath('journal.db')
+    with CopyJournal(fn) as journal:
+        # a copy of big.bin was interrupted after its first MiB
+        dst.mkdir()
+        dst.joinpath('big.bin').write_bytes(b'x' * (1024 * 1024 + 10))
+        journal.set_offset(big, dst.joinpath('big.bin'), big.stat(),
+                           1024 * 1024)
+        stats = advanced_copy(src, dst, sync='always', journal=journal)
+        assert sum(stats.values()) == 4
+        assert len(journal) == 4
+    content = dst.joinpath('big.bin').read_bytes()
+    assert content[:1024 * 1024] == b'x' * (1024 * 1024)
+    assert content[1024 * 1024:] == data[1024 * 1024:]
+    # files copied are skipped without being compared
+    stats = advanced_copy(src, dst, sync='always', journal=fn)
+    assert stats['uptodate'] == 4
+    dst.joinpath('a.txt').write_text('AAAAA')
+    stats = advanced_copy(src, dst, sync='always', journal=fn)
+    assert stats['uptodate'] == 3
+    assert dst.joinpath('a.txt').read_text() == 'aaaa'
+
+
+def test_atomic_copy(tmp_path, monkeypatch):
+    import pytest
+    import ngofile.copyfile
+    from ngofile.copyfile import SafeWriter
+
+    writer = SafeWriter(atomic=True, fsync='dir')
+    dst = tmp_path.joinpath('f.txt')
+    target = writer.target(dst)
+    assert os.path.basename(target) == '.f.txt.part'
+    with open(target, 'w') as f:
+        f.write('data')
+    done = []
+    writer.commit(target, str(dst), lambda: done.append(1))
+    # files are only renamed once synced with their directory
+    assert not dst.exists() and not done
+    writer.end_dir(tmp_path)
+    assert dst.read_text() == 'data' and done == [1]
+    with pytest.raises(ValueError):
+        SafeWriter(fsync='always')
+
+    # directory of a file created in place is synced too
+    synced = []
+    monkeypatch.setattr(ngofile.copyfile, '_fsync_dir', synced.append)
+    writer = SafeWriter(fsync='file')
+    for name in ('new.txt', 'f.txt'):
+        dst = str(tmp_path.joinpath(name))
+        target = writer.target(dst)
+        assert target == dst
+        with open(target, 'w') as f:
+            f.write('data')
+        writer.commit(target, dst)
+    assert synced == [str(tmp_path)]
+    monkeypatch.undo()
+
+    src = tmp_path.joinpath('src')
+    _tree(src)
+    for fsync in (None, 'file', 'dir'):
+        dst = tmp_path.joinpath('dst_%s' % fsync)
+        advanced_copy(src, dst, atomic=True, fsync=fsync, workers=2)
+        assert dst.joinpath('sub', 'b.txt').read_text() == 'bbbb'
+        assert not list(dst.glob('**/*.part'))
+        assert dst.joinpath('sub').stat().st_mtime == 1e9
+    advanced_copy(src.joinpath('a.txt'), tmp_path.joinpath('one'),
+                  fsync='dir')
+    assert tmp_path.joinpath('one', 'a.txt').read_text() == 'aaaa'
+
+
+def test_dedup_copy(tmp_path, monkeypatch):
+    import ngofile.copyfile
+    import ngofile.digests
+
+    src = tmp_path.joinpath('src')
+    _tree(src)
+    for v in ('v1', 'v2'):
+        src.joinpath(v).mkdir()
+        src.joinpath(v, 'lib.py').write_text('vendored')
+    snap1 = tmp_path.joinpath('snap1')
+    stats = advanced_copy(src, snap1, dedup='hardlink')
+    assert stats['hardlink'] == 1
+    assert snap1.joinpath('v1', 'lib.py').stat().st_ino == \
+        snap1.joinpath('v2', 'lib.py').stat().st_ino
+
+    # unchanged files are linked to the previous snapshot
+    src.joinpath('a.txt').write_text('new')
+    snap2 = tmp_path.joinpath('snap2')
+    hashed = []
+    monkeypatch.setattr(ngofile.digests, 'file_digest',
+                        lambda *args: hashed.append(args))
+    stats = advanced_copy(src, snap2, link_dest=snap1)
+    # link-dest alone does not hash files
+    assert not hashed
+    monkeypatch.undo()
+    assert stats['hardlink'] == 4
+    assert snap2.joinpath('sub', 'b.txt').stat().st_ino == \
+        snap1.joinpath('sub', 'b.txt').stat().st_ino
+    assert snap2.joinpath('a.txt').read_text() == 'new'
+    assert snap1.joinpath('a.txt').read_text() == 'aaaa'
+
+    # reflinks need a copy-on-write file system, files are copied otherwise
+    snap3 = tmp_path.joinpath('snap3')
+    advanced_copy(src, snap3, dedup='reflink')
+    assert snap3.joinpath('v2', 'lib.py').read_text() == 'vendored'
+    assert snap3.joinpath('v2', 'lib.py').stat().st_nlink == 1
+
+    # linked files are synced as copied ones
+    for fsync in ('file', 'dir'):
+        synced = []
+        monkeypatch.setattr(ngofile.copyfile, '_fsync', synced.append)
+        monkeypatch.setattr(ngofile.copyfile, '_fsync_dir', synced.append)
+        snap4 = tmp_path.joinpath('snap4_%s' % fsync)
+        stats = advanced_copy(src, snap4, dedup='hardlink', fsync=fsync)
+        monkeypatch.undo()
+        assert stats['hardlink'] == 1
+        for v in ('v1', 'v2'):
+            assert str(snap4.joinpath(v, 'lib.py')) in synced
+            assert str(snap4.joinpath(v)) in synced
+
+
+def test_mirror_copy(tmp_path):
+    src = tmp_path.joinpath('src')
+    dst = tmp_path.joinpath('dst')
+    _tree(src)
+    for workers in (0, 2):
+        advanced_copy(src, dst, excludes=['*.log'])
+        dst.joinpath('extra.txt').write_text('x')
+        dst.joinpath('keep.log').write_text('x')
+        dst.joinpath('old', 'deep').mkdir(parents=True)
+        dst.joinpath('old', 'deep', 'x.txt').write_text('x')
+        dst.joinpath('sub', 'stale.txt').write_text('x')
+
+        plan = advanced_copy(src, dst, excludes=['*.log'], mirror=True,
+                             dry_run=True)
+        assert plan.counts()['delete'] == 5
+        assert dst.joinpath('extra.txt').exists()
+        stats = advanced_copy(src, dst, excludes=['*.log'], mirror=True,
+                              workers=workers)
+        assert stats['deleted'] == 5
+        assert sorted([str(p.relative_to(dst)) for p in dst.rglob('*')]) == [
+            'a.txt', 'keep.log', 'sub', os.path.join('sub', 'b.txt')
+        ]
+        # deletions are done before directory stats are copied
+        assert dst.joinpath('sub').stat().st_mtime == 1e9
+        dst.joinpath('keep.log').unlink()
+
+
+def test_update_linked_copy(tmp_path):
+    src = tmp_path.joinpath('src')
+    _tree(src)
+    for v in ('v1', 'v2'):
+        src.joinpath(v).mkdir()
+        src.joinpath(v, 'lib.py').write_text('vendored')
+    dst = tmp_path.joinpath('dst')
+    advanced_copy(src, dst, dedup='hardlink')
+    s1 = tmp_path.joinpath('s1')
+    s2 = tmp_path.joinpath('s2')
+    advanced_copy(src, s1)
+    advanced_copy(src, s2, link_dest=s1)
+    assert s2.joinpath('a.txt').stat().st_nlink == 2
+
+    # updates replace linked files instead of writing through their links
+    src.joinpath('a.txt').write_text('new')
+    src.joinpath('v1', 'lib.py').write_text('patched')
+    advanced_copy(src, s2)
+    assert s2.joinpath('a.txt').read_text() == 'new'
+    assert s1.joinpath('a.txt').read_text() == 'aaaa'
+    advanced_copy(src, dst, fanout=True)
+    assert dst.joinpath('v1', 'lib.py').read_text() == 'patched'
+    assert dst.joinpath('v2', 'lib.py').read_text() == 'vendored'
+    s3 = tmp_path.joinpath('s3')
+    s4 = tmp_path.joinpath('s4')
+    advanced_copy(src, [s3, s4], link_dest=s1)
+    src.joinpath('sub', 'b.txt').write_text('BBBB')
+    advanced_copy(src, [s3, s4], fanout=True)
+    assert s3.joinpath('sub', 'b.txt').read_text() == 'BBBB'
+    assert s1.joinpath('sub', 'b.txt').read_text() == 'bbbb'
+
+
+def test_unsupported_backend(tmp_path):
+    import pytest
+    from ngofile.copyfile import copyfile
+    from ngofile.exceptions import CopyException
+    from ngofile.exceptions import UnsupportedCopyException
+
+    src = tmp_path.joinpath('src')
+    _tree(src)
+    try:
+        copyfile(src.joinpath('a.txt'), tmp_path.joinpath('x'), ['reflink'])
+        pytest.skip('file system supports reflinks')
+    except UnsupportedCopyException:
+        pass
+    # each file which cannot be copied is reported, the others are copied
+    with pytest.raises(CopyException) as exc:
+        advanced_copy(src, tmp_path.joinpath('dst'), backends=['reflink'])
+    assert len(exc.value.args[0]) == 3
+    # temporary files of failed copies are removed
+    with pytest.raises(CopyException):
+        advanced_copy(src, tmp_path.joinpath('dst'), backends=['reflink'],
+                      atomic=True)
+    assert not list(tmp_path.joinpath('dst').glob('**/.*.part'))
+    plan = advanced_copy(src, tmp_path.joinpath('dst'), dry_run=True)
+    with pytest.raises(CopyException):
+        advanced_copy(plan=plan, backends=['reflink'])
+
+
+def test_copy_patterns_case(tmp_path):
+    src = tmp_path.joinpath('src')
+    src.joinpath('Sub').mkdir(parents=True)
+    for n in ('a.C', 'b.c', 'Sub/d.C', 'Sub/e.c'):
+        src.joinpath(n).write_text(n)
+    dst = tmp_path.joinpath('dst')
+    # copy patterns are case sensitive
+    advanced_copy(src, dst, includes=['*.C'], excludes=['sub/d.*'])
+    assert sorted([str(p.relative_to(dst)) for p in dst.rglob('*.*')]) == \
+        sorted(['a.C', os.path.join('Sub', 'd.C')])
+    dst.joinpath('x.c').write_text('x')
+    stats = advanced_copy(src, dst, includes=['*.C'], mirror=True)
+    assert stats['deleted'] == 0 and dst.joinpath('x.c').exists()
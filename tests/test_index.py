@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for index
+
+author: Cedric ROMAN
+email: roman@numengo.com
+licence: GNU GPLv3
+"""
+from __future__ import unicode_literals
+
+import os
+import time
+
+from ngofile.index import ListingIndex
+from ngofile.list_files import list_files
+
+
+def _age(*dirs):
+    # make directories old enough to be trusted by index
+    t = time.time() - 60
+    for d in dirs:
+        os.utime(str(d), (t, t))
+
+
+def test_listing_index(tmp_path):
+    root = tmp_path.joinpath('root')
+    sub = root.joinpath('sub')
+    sub.mkdir(parents=True)
+    root.joinpath('a.txt').write_text('a')
+    sub.joinpath('b.txt').write_text('b')
+    _age(root, sub)
+
+    db = tmp_path.joinpath('index.db')
+    with ListingIndex(db) as index:
+        fs1 = list_files(root, recursive=True, index=index)
+        assert index.misses == 2 and index.hits == 0
+        fs2 = list_files(root, recursive=True, index=index)
+        assert index.hits == 2
+        assert sorted(fs1) == sorted(fs2)
+        assert len(fs2) == 2
+
+    # only modified directory is read again, with a persisted index
+    sub.joinpath('c.txt').write_text('c')
+    _age(sub)
+    with ListingIndex(db) as index:
+        fs3 = list_files(root, "*.txt", recursive=True, index=index)
+        assert index.hits == 1 and index.misses == 1
+        assert len(fs3) == 3
+    # index can be given as filename
+    assert len(list_files(root, recursive=True, index=db)) == 3
@@ -6,12 +6,16 @@ licence: GNU GPLv3
 """
 from __future__ import unicode_literals
 
+import os
 import zipfile
+from builtins import range
 from builtins import str
 from pathlib import Path
 
 from ngofile.list_files import list_files
 from ngofile.list_files import list_files_in_zip
+from ngofile.list_files import yield_entries
+from ngofile.patterns import PatternSet
 
 test_file = Path(__file__).resolve()
 test_dir = Path(__file__).resolve().parent
@@ -40,6 +44,112 @@ def test_list_files_with_patterns():
     assert str(test_file) == str(next(list_files(test_file)))
 
 
+def test_yield_entries():
+    es = list(yield_entries(test_dir_a, "*.data", recursive=True))
+    assert len(es) == 9
+    # entries carry their type and stat information
+    assert all(e.is_file() for e in es)
+    assert all(e.stat().st_size == os.path.getsize(e.path) for e in es)
+    es = list(yield_entries(test_dir_a, recursive=True, folders=2))
+    assert len(es) == 8
+    assert all(e.is_dir() for e in es)
+    e = next(yield_entries(test_file))
+    assert e.name == test_file.name
+    assert e.stat().st_size == test_file.stat().st_size
+
+
+def test_pattern_set():
+    ps = PatternSet.compile(["*.data", "*.txt"], "bb")
+    # pattern sets are cached by patterns
+    assert ps is PatternSet.compile(("*.txt", "*.data"), ["bb"])
+    assert ps.include("_.DATA") and not ps.include("_.py")
+    assert ps.exclude("bb") and not ps.exclude("bbb")
+    assert ps.with_excludes("bbb").exclude("bbb")
+    # relative paths are matched through their parent directories
+    ps = PatternSet.compile(["aa/**/*.data", "*.txt"], ["bbb"])
+    assert ps.match("aa/y.data") and ps.match("aa/x/y.data")
+    assert not ps.match("aa/bbb/y.data") and not ps.match("b/y.data")
+    assert ps.match("x/r.txt") and not ps.match("r.py")
+
+
+def test_concurrent_listings():
+    from threading import Thread
+    results = {}
+
+    def target(i):
+        incl = "*.data" if i % 2 else "*.txt"
+        results[i] = list_files(test_dir_a, incl, ["bb"], recursive=True)
+
+    threads = [Thread(target=target, args=(i, )) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i, fs in results.items():
+        assert len(fs) == 5
+        assert all(f.suffix == (".data" if i % 2 else ".txt") for f in fs)
+
+
+def test_list_files_prune_excludes(monkeypatch):
+    import ngofile.list_files
+    read = []
+
+    def scandir(path):
+        read.append(os.path.relpath(path, str(test_dir_a)))
+        return os.scandir(path)
+
+    monkeypatch.setattr(ngofile.list_files, 'scandir', scandir)
+    # path excludes are relative to root, excluded directories are not read
+    fs = list_files(test_dir_a, "*.data", ["aa/bbb"], recursive=True)
+    assert len(fs) == 8
+    assert os.path.join('aa', 'bbb') not in read
+    del read[:]
+    fs = list_files(test_dir_a, "*.data", ["**/bbb", "bb/**"], recursive=True)
+    assert len(fs) == 4
+    assert sorted(read) == ['.', 'aa', os.path.join('aa', 'aaa'),
+                            os.path.join('aa', 'ccc')]
+    fs = list_files(test_dir_a, "*.data", ["*/c*"], recursive=True)
+    assert len(fs) == 7
+    fs = list_files(test_dir_a, "*.data", [str(test_dir_a.joinpath('bb'))],
+                    recursive=True)
+    assert len(fs) == 5
+
+
+def test_list_files_globstar(monkeypatch):
+    import ngofile.list_files
+    read = []
+
+    def scandir(path):
+        read.append(os.path.relpath(path, str(test_dir_a)))
+        return os.scandir(path)
+
+    # globstar in source implies recursion
+    assert len(list_files(test_dir_a.joinpath('**', '*.data'))) == 9
+    assert len(list_files(test_dir_a, 'aa/**')) == 8
+    # name patterns apply in all directories walked
+    assert len(list_files(test_dir_a, ['aa/*/_.data', '*.txt'])) == 8
+    fs = list_files(test_dir_a, ['**/aaa/*', 'bb/_.*'], ['*.txt'])
+    assert len(fs) == 3
+    # directories no include can match are not read
+    monkeypatch.setattr(ngofile.list_files, 'scandir', scandir)
+    fs = list_files(test_dir_a, 'aa/b*/*.data', recursive=True)
+    assert len(fs) == 1
+    assert sorted(read) == ['.', 'aa', os.path.join('aa', 'bbb')]
+    # recursively, the last segment of a path include matches below it
+    assert len(list_files(test_dir_a, ['aa/*.data'], recursive=True)) == 4
+    assert len(list_files(test_dir_a, ['aa/*.data'])) == 1
+
+
+def test_list_files_with_workers():
+    fs = list_files(test_dir_a, "*.data", ["bb"], recursive=True, folders=1)
+    fs1 = list_files(test_dir_a, "*.data", ["bb"], recursive=True, folders=1,
+                     workers=4)
+    assert sorted(fs1) == sorted(fs)
+    fs2 = list_files(test_dir_a, "*.data", ["bb"], recursive=True, folders=1,
+                     workers=4, ordered=True)
+    assert fs2 == fs
+
+
 def test_list_files_in_zip():
     f = test_dir.joinpath('tmp_dir_py.zip')
     z = zipfile.ZipFile(str(f), 'r')
@@ -49,5 +159,95 @@ def test_list_files_in_zip():
     z.close()
 
 
+def test_archive_index():
+    from ngofile.archives import ArchiveIndex
+    idx = ArchiveIndex(['a/', 'a/x.py', 'a/b/y.py', 'a/b/c/z.txt', 'r.py',
+                        'd/e/f.py'])
+    assert idx.query("*.py") == ['r.py']
+    assert idx.query("*.py", recursive=True) == [
+        'a/x.py', 'a/b/y.py', 'r.py', 'd/e/f.py']
+    assert idx.query("a/*", recursive=False) == ['a/x.py', 'a/b/y.py']
+    assert idx.query("a", "*.py", recursive=True) == ['a/', 'a/b/c/z.txt']
+    assert idx.query("d/e/f.py") == ['d/e/f.py']
+    assert idx.query("x/*") == []
+    # directories are known from member paths, even without their own member
+    assert idx.is_dir("a") and idx.is_dir("d/e") and idx.is_dir("")
+    assert not idx.is_dir("r.py") and not idx.is_dir("x")
+
+    f = test_dir.joinpath('tmp_dir_py.zip')
+    with zipfile.ZipFile(str(f), 'r') as z:
+        # index is built once per zip file
+        assert ArchiveIndex.for_zip(z) is ArchiveIndex.for_zip(z)
+        assert list_files_in_zip(z, "*/*.py") == ['tmp_dir_py/test.py']
+
+
+def test_list_files_in_archive(tmp_path):
+    import tarfile
+    from ngofile.archives import ArchiveIndex
+    from ngofile.list_files import list_files_in_archive
+
+    f = tmp_path.joinpath('a.tar.gz')
+    with tarfile.open(str(f), 'w:gz') as tar:
+        tar.add(str(test_dir_a), arcname='a')
+    ls = list_files_in_archive(f, "*.data", recursive=True)
+    assert len(ls) == 9
+    ls = list_files_in_archive(f, "a/*.*", ["*.txt"])
+    assert ls == ['a/_.data']
+    # index is cached until archive is modified
+    assert ArchiveIndex.get(f) is ArchiveIndex.get(str(f))
+    with tarfile.open(str(f), 'r:gz') as tar:
+        assert list_files_in_archive(tar, "a/_.*") == ['a/_.data', 'a/_.txt']
+    z = test_dir.joinpath('tmp_dir_py.zip')
+    assert list_files_in_archive(z, "*.py", recursive=True) == [
+        'tmp_dir_py/test.py']
+
+
+def test_list_files_into_archives(tmp_path):
+    import tarfile
+
+    tmp_path.joinpath('x.py').write_text('x')
+    with zipfile.ZipFile(str(tmp_path.joinpath('b.zip')), 'w') as z:
+        z.writestr('inner/y.py', 'y')
+        z.writestr('inner/y.txt', 'y')
+        z.writestr('build/z.py', 'z')
+    with tarfile.open(str(tmp_path.joinpath('c.tar.gz')), 'w:gz') as tar:
+        tar.add(str(test_dir_a), arcname='a')
+    fs = list_files(tmp_path, "*.py", ["build"], recursive=True,
+                    into_archives=True)
+    fs = sorted([f.relative_to(tmp_path).as_posix() for f in fs])
+    assert fs == ['b.zip!/inner/y.py', 'x.py']
+    # archives are not walked by default, nor in a non recursive listing
+    assert len(list_files(tmp_path, "*.py", recursive=True)) == 1
+    assert len(list_files(tmp_path, "*.py", into_archives=True)) == 1
+    fs = list_files(tmp_path, "*.data", recursive=True, into_archives=True)
+    assert len(fs) == 9
+    assert all('c.tar.gz!/a/' in f.as_posix() for f in fs)
+    fs2 = list_files(tmp_path, "*.data", recursive=True, workers=4,
+                     ordered=True, into_archives=True)
+    assert fs2 == fs
+
+
+def test_list_files_into_bad_archives(tmp_path, caplog, monkeypatch):
+    import ngofile.archives
+
+    tmp_path.joinpath('x.py').write_text('x')
+    tmp_path.joinpath('bad.zip').write_text('not a zip')
+    read = []
+    read_members = ngofile.archives._read_members
+
+    def _read_members(path):
+        read.append(path)
+        return read_members(path)
+
+    monkeypatch.setattr(ngofile.archives, '_read_members', _read_members)
+    for i in range(3):
+        fs = list_files(tmp_path, "*.py", recursive=True, into_archives=True)
+        assert len(fs) == 1
+    # archive is read and warned about once, until it is modified
+    assert len(read) == 1
+    warnings = [r for r in caplog.records if 'bad.zip' in r.getMessage()]
+    assert len(warnings) == 1
+
+
 if __name__ == '__main__':
     test_list_files_with_patterns()
@@ -9,10 +9,13 @@ licence: GNU GPLv3
 from __future__ import unicode_literals
 
 import logging
+import os
 from builtins import object
 from builtins import str
 from pathlib import Path
 
+import pytest
+
 from ngofile.pathlist import PathList
 
 test_file = Path(__file__).resolve()
@@ -34,6 +37,176 @@ class TestPathList(object):
         p2 = a.pick_first(test_file.name)
         assert p2.exists()
         assert not a.exists('dummy.dum')
+        p3 = a.pick_first('a/**/bbb/*.data')
+        assert p3.parent.name == 'bbb'
+        assert a.pick_first('a/*.dum') is None
+
+
+def test_pick_first_cache(tmp_path):
+    root = tmp_path.joinpath('root')
+    root.mkdir()
+    root.joinpath('a.txt').write_text('a')
+    pl = PathList(root, cache_size=2)
+    assert pl.pick_first('a.txt').name == 'a.txt'
+    assert pl.pick_first('a.txt').name == 'a.txt'
+    assert pl.pick_first('*.txt').name == 'a.txt'
+    assert pl.pick_first('b.txt') is None
+    info = pl.cache_info()
+    assert info['hits'] == 1 and info['misses'] == 3 and info['size'] == 2
+    # least recently used resolution was evicted
+    pl.pick_first('a.txt')
+    assert pl.cache_info()['misses'] == 4
+    # cache is cleared when pathlist changes
+    other = tmp_path.joinpath('other')
+    other.mkdir()
+    other.joinpath('b.txt').write_text('b')
+    pl.add(other)
+    assert pl.cache_info()['size'] == 0
+    assert pl.pick_first('b.txt').name == 'b.txt'
+    # or when the mtime of its directories changes
+    pl = PathList(root, cache_size=10, check_mtime=True)
+    assert pl.pick_first('c.txt') is None
+    root.joinpath('c.txt').write_text('c')
+    os.utime(str(root), (0, 0))
+    assert pl.pick_first('c.txt').name == 'c.txt'
+    # resolutions deleted are not returned
+    root.joinpath('c.txt').unlink()
+    os.utime(str(root), (0, 0))
+    assert pl.pick_first('c.txt') is None
+    # cache is disabled by default
+    pl = PathList(root)
+    assert pl.pick_first('d.txt') is None
+    root.joinpath('d.txt').write_text('d')
+    assert pl.pick_first('d.txt').name == 'd.txt'
+
+
+def test_adaptive_order(tmp_path):
+    roots = [tmp_path.joinpath(n) for n in ('r1', 'r2', 'r3')]
+    for r in roots:
+        r.mkdir()
+    roots[2].joinpath('hot.txt').write_text('h')
+    roots[1].joinpath('warm.txt').write_text('w')
+    pl = PathList(*roots, cache_size=0)
+    order = [p for p, _c in pl.root_stats()]
+    assert order == [r.resolve() for r in roots]
+    for _i in range(3):
+        assert pl.pick_first('hot.txt').name == 'hot.txt'
+    pl.pick_first('warm.txt')
+    pl.pick_first('missing.txt')
+    stats = pl.root_stats()
+    assert stats[0] == (roots[2].resolve(), 3)
+    assert stats[1] == (roots[1].resolve(), 1)
+    assert stats[2] == (roots[0].resolve(), 0)
+    # listings also follow the probing order
+    assert pl.list_files()[0].name == 'hot.txt'
+
+
+def test_name_index(tmp_path):
+    r1 = tmp_path.joinpath('r1')
+    r2 = tmp_path.joinpath('r2')
+    r1.joinpath('sub').mkdir(parents=True)
+    r2.joinpath('sub', 'deep').mkdir(parents=True)
+    r1.joinpath('sub', 'a.txt').write_text('1')
+    r2.joinpath('sub', 'a.txt').write_text('2')
+    r2.joinpath('sub', 'deep', 'b.txt').write_text('2')
+    pl = PathList(r1, r2, cache_size=0)
+    pl.build_index()
+    assert pl.pick_first('sub/a.txt') == r1.resolve().joinpath('sub/a.txt')
+    assert pl.pick_first('sub/deep/b.txt').parent.name == 'deep'
+    assert pl.exists('sub/deep')
+    assert not pl.exists('sub/c.txt')
+    assert pl.find_name('a.txt') == r1.resolve().joinpath('sub/a.txt')
+    assert pl.find_name('b.txt').name == 'b.txt'
+    # index is only updated by a refresh
+    r1.joinpath('sub', 'c.txt').write_text('1')
+    assert not pl.exists('sub/c.txt')
+    pl.refresh_index('sub')
+    assert pl.exists('sub/c.txt')
+    # added paths are indexed with lowest priority
+    r3 = tmp_path.joinpath('r3')
+    r3.mkdir()
+    r3.joinpath('d.txt').write_text('3')
+    pl.add(r3)
+    assert pl.find_name('d.txt') == r3.resolve().joinpath('d.txt')
+    pl.drop_index()
+    assert pl.exists('sub/c.txt')
+
+
+def test_pick_first_many(tmp_path):
+    r1 = tmp_path.joinpath('r1')
+    r2 = tmp_path.joinpath('r2')
+    r1.joinpath('inc').mkdir(parents=True)
+    r2.joinpath('inc').mkdir(parents=True)
+    r1.joinpath('inc', 'a.h').write_text('1')
+    r2.joinpath('inc', 'a.h').write_text('2')
+    r2.joinpath('inc', 'b.h').write_text('2')
+    r2.joinpath('c.h').write_text('2')
+    names = ['inc/a.h', 'inc/b.h', 'c.h', 'inc/d.h', 'inc/*.h', 'inc/a.h']
+    for workers in (0, 4):
+        pl = PathList(r1, r2)
+        res = pl.pick_first_many(names, workers=workers)
+        assert res == [pl.pick_first(n) for n in names]
+        assert res[0] == r1.resolve().joinpath('inc/a.h')
+        assert res[1] == r2.resolve().joinpath('inc/b.h')
+        assert res[3] is None
+
+
+def test_lazy_extend(tmp_path):
+    dirs = [tmp_path.joinpath('d%i' % i) for i in range(5)]
+    for d in dirs:
+        d.mkdir()
+    dirs[3].joinpath('x.txt').write_text('x')
+    pl = PathList(*dirs[:2], lazy=True)
+    pl.extend(dirs[2:] + [tmp_path.joinpath('missing'), dirs[0]])
+    assert pl._pending  # nothing validated yet
+    assert pl.pick_first('x.txt').name == 'x.txt'
+    assert not pl._pending
+    assert len(pl) == 5
+    assert dirs[1] in pl and str(dirs[1]) in pl
+    assert tmp_path.joinpath('missing') not in pl
+    pl2 = PathList(workers=4)
+    pl2.extend([str(tmp_path.joinpath('d*'))] + dirs, workers=4)
+    assert [p for p, _c in pl2.root_stats()] == [d.resolve() for d in dirs]
+
+
+def _check_watch(tmp_path, backend):
+    root = tmp_path.joinpath(backend)
+    root.joinpath('sub').mkdir(parents=True)
+    root.joinpath('sub', 'a.txt').write_text('a')
+    pl = PathList(root, watch=backend)
+    try:
+        watcher = pl._watcher
+        assert [f.name for f in pl.list_files(recursive=True)] == ['a.txt']
+        misses = watcher.misses
+        assert len(pl.list_files(recursive=True)) == 1
+        assert watcher.misses == misses  # answered from memory
+        assert not pl.exists('nodir/x.txt')
+        misses = watcher.misses
+        assert not pl.exists('nodir/x.txt')
+        assert watcher.misses == misses  # missing parent known from memory
+        assert pl.pick_first('sub/a.txt') is not None
+        root.joinpath('sub', 'b.txt').write_text('b')
+        root.joinpath('sub', 'a.txt').unlink()
+        root.joinpath('new').mkdir()
+        root.joinpath('new', 'c.txt').write_text('c')
+        if backend == 'poll':
+            watcher.poll()
+        fs = sorted([f.name for f in pl.list_files(recursive=True)])
+        assert fs == ['b.txt', 'c.txt']
+        assert pl.pick_first('sub/a.txt') is None
+        assert pl.pick_first('**/c.*').name == 'c.txt'
+    finally:
+        pl.unwatch()
+    assert not pl.watched
+
+
+def test_watch_poll(tmp_path):
+    _check_watch(tmp_path, 'poll')
+
+
+def test_watch_inotify(tmp_path):
+    pytest.importorskip('inotify_simple')
+    _check_watch(tmp_path, 'inotify')
 
 
 if __name__ == '__main__':